@@ -0,0 +1,267 @@
+"""
+Caching of filter choices, using Django's cache framework.
+
+Only the data that comes from the database is cached - the labels, counts and
+the values of the filter's own query parameter. The links themselves depend on
+the rest of the query string, and are rebuilt for each request.
+
+Cached choices are invalidated by a version number for each model involved,
+which is changed whenever an instance of the model is saved or deleted. The
+signal handlers that do this are connected when this module is imported, so
+that changes made in any process invalidate the choices.
+
+This module also provides LabelCache, a process-local cache of the labels of
+related objects, which is invalidated in the same way.
+"""
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_delete, post_save
+import six
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+KEY_PREFIX = 'easyfilters'
+
+# {model: set of cache aliases that need invalidating when it changes}, for
+# aliases that are not in the EASYFILTERS_CACHE_ALIASES setting.
+_watched = {}
+_watched_lock = threading.Lock()
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def version_key(model):
+    return '%s:version:%s' % (KEY_PREFIX, model_label(model))
+
+
+def new_version():
+    # Based on time, so that a version that has been evicted from the cache is
+    # not reused.
+    return int(time.time() * 1000000)
+
+
+def get_versions(cache, models):
+    """
+    Returns the current version numbers for the models, as a list.
+    """
+    keys = [version_key(m) for m in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, new_version(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def get_cache_aliases():
+    """
+    Returns the names of the caches that hold choices for any process, from the
+    EASYFILTERS_CACHE_ALIASES setting, which defaults to ['default'].
+    """
+    return getattr(settings, 'EASYFILTERS_CACHE_ALIASES', ['default'])
+
+
+def invalidate_model(sender, **kwargs):
+    """
+    Signal handler that invalidates all cached choices that depend on the model
+    'sender'.
+    """
+    aliases = set(get_cache_aliases())
+    aliases.update(_watched.get(sender, ()))
+    for alias in aliases:
+        # get_versions() starts a new version when it is missing.
+        get_cache(alias).delete(version_key(sender))
+
+
+def watch_models(alias, models):
+    """
+    Ensures that changes to any of 'models' made in this process will
+    invalidate cached choices in the cache 'alias', if it isn't one of
+    get_cache_aliases().
+    """
+    if alias in get_cache_aliases():
+        return
+    with _watched_lock:
+        for model in models:
+            _watched.setdefault(model, set()).add(alias)
+
+
+for signal in [post_save, post_delete, m2m_changed]:
+    signal.connect(invalidate_model, weak=False,
+                   dispatch_uid='django_easyfilters.cache.invalidate_model')
+
+
+def make_key(*parts):
+    # 'parts' must have a stable repr()
+    data = repr(parts)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    return '%s:choices:%s' % (KEY_PREFIX, hashlib.md5(data).hexdigest())
+
+
+def option_key(value):
+    """
+    Returns a version of a filter option for make_key(). Callables, whose repr()
+    includes their address, are identified by their module and name instead.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(option_key(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((k, option_key(v)) for k, v in value.items())
+    if callable(value):
+        name = getattr(value, '__qualname__', None) or getattr(value, '__name__', None)
+        if name is None:
+            # e.g. an instance with __call__
+            name = value.__class__.__name__
+            module = value.__class__.__module__
+        else:
+            module = getattr(value, '__module__', None)
+        return ('callable', module, name)
+    return value
+
+
+def make_fingerprint(data):
+    """
+    Returns a short string that changes when the JSON-compatible 'data' does.
+    """
+    data = json.dumps(data, sort_keys=True)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    return hashlib.md5(data).hexdigest()[:12]
+
+
+def query_key(qs):
+    """
+    Returns something that identifies the query that the QuerySet will run.
+    """
+    sql, params = qs.query.get_compiler(qs.db).as_sql()
+    return (qs.db, sql, tuple(params))
+
+
+def dump_choices(filter_, choices):
+    """
+    Converts a list of FilterChoice objects into data suitable for the cache.
+    """
+    return [(six.text_type(c.label),
+             c.count,
+             c.get_paramlist(filter_.query_param),
+             c.link_type,
+             c.is_estimate,
+             c.is_capped)
+            for c in choices]
+
+
+def load_choices(filter_, data):
+    """
+    Converts data from dump_choices back into FilterChoice objects.
+    """
+    # Imported here to avoid a circular import
+    from .filters import FilterChoice, FilterLink
+    return [FilterChoice(label,
+                         count,
+                         None if paramlist is None else FilterLink(filter_, paramlist),
+                         link_type,
+                         is_estimate,
+                         is_capped)
+            for label, count, paramlist, link_type, is_estimate, is_capped in data]
+
+
+def run_in_thread(using, func, *args):
+    """
+    Runs func(*args) in a new thread, which closes its own database connection
+    when finished.
+    """
+    def run():
+        try:
+            func(*args)
+        finally:
+            connections[using].close()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class LabelCache(object):
+    """
+    A bounded, least recently used, mapping of {value: label data} for the
+    related objects of a filter, that persists between requests.
+    """
+    def __init__(self, size, attname):
+        # attname is the attribute of the related model that 'value' is taken
+        # from.
+        self.size = size
+        self.attname = attname
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    # Move to the end, as most recently used.
+                    found[key] = self.data[key] = self.data.pop(key)
+        return found
+
+    def set_many(self, data):
+        with self.lock:
+            for key, val in data.items():
+                self.data.pop(key, None)
+                self.data[key] = val
+            while len(self.data) > self.size:
+                del self.data[next(iter(self.data))]
+
+    def invalidate(self, instance):
+        with self.lock:
+            self.data.pop(getattr(instance, self.attname), None)
+
+
+# {key: LabelCache}
+_label_caches = {}
+# {model: list of LabelCache objects for that model}
+_label_caches_by_model = {}
+
+
+def get_label_cache(key, model, attname, size):
+    """
+    Returns the LabelCache for 'key', which stores labels for instances of
+    'model', creating it if necessary.
+    """
+    with _watched_lock:
+        if key not in _label_caches:
+            if model not in _label_caches_by_model:
+                _label_caches_by_model[model] = []
+                uid = 'django_easyfilters.cache.labels.%s' % model_label(model)
+                for signal in [post_save, post_delete]:
+                    signal.connect(invalidate_labels, sender=model,
+                                   weak=False, dispatch_uid=uid)
+            _label_caches[key] = LabelCache(size, attname)
+            _label_caches_by_model[model].append(_label_caches[key])
+        return _label_caches[key]
+
+
+def invalidate_labels(sender, instance, **kwargs):
+    for label_cache in _label_caches_by_model.get(sender, ()):
+        label_cache.invalidate(instance)
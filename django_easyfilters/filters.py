@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+from collections import namedtuple
 from datetime import date
 from dateutil.relativedelta import relativedelta
 import math
@@ -8,11 +9,16 @@ import re
 
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.query_utils import deferred_class_factory
 from django.utils.dates import MONTHS
-from django.db.models.fields import DateTimeField
+from django.http import QueryDict
+from django.utils.datastructures import SortedDict
 import six
 
-from django_easyfilters.queries import date_aggregation, value_counts, numeric_range_counts
+from django_easyfilters import cache
+from django_easyfilters.queries import (date_histogram, value_counts, value_stats, numeric_range_counts,
+                                        can_sample, count_at_most, sample_queryset, scale_counts,
+                                        capped_value_counts, keyset_lookup)
 from django_easyfilters.ranges import auto_ranges
 from django_easyfilters.utils import python_2_unicode_compatible
 
@@ -26,30 +32,137 @@ else:
     total_ordering = lambda c: c
 
 
-try:
-    from collections import namedtuple
-    FilterChoice = namedtuple('FilterChoice', 'label count params link_type')
-except ImportError:
-    # We don't use it as a tuple, so this will do:
-    class FilterChoice(object):
-        def __init__(self, label, count, params, link_type):
-            self.label, self.count, self.params, self.link_type = label, count, params, link_type
+class FilterLink(object):
+    """
+    The parameters for the link of a choice, as a list of values for the
+    filter's query parameter. The full parameters and the querystring are only
+    built when needed.
+    """
+    def __init__(self, filter_, paramlist):
+        self.filter = filter_
+        self.paramlist = paramlist
+
+    def get_params(self):
+        return self.filter.params_from_paramlist(self.paramlist)
+
+    def urlencode(self):
+        return self.filter.urlencode_paramlist(self.paramlist)
+
+
+class FilterChoice(namedtuple('FilterChoice', 'label count params link_type')):
+    """
+    A choice for a filter, as a namedtuple of (label, count, params, link_type),
+    where params are the new params (a QueryDict, or None for FILTER_DISPLAY).
+    params can be passed as a FilterLink, so that it is only built if it is
+    used. is_estimate is True if the count was estimated from a sample, and
+    is_capped is True if the actual count is more than 'count'.
+    """
+    is_estimate = False
+    is_capped = False
+
+    def __new__(cls, label, count, params, link_type, is_estimate=False, is_capped=False):
+        # The FilterLink (or QueryDict) is stored in the tuple, and is only
+        # converted when params are accessed, including by indexing or
+        # unpacking.
+        self = super(FilterChoice, cls).__new__(cls, label, count, params, link_type)
+        if is_estimate:
+            self.is_estimate = True
+        if is_capped:
+            self.is_capped = True
+        return self
+
+    @property
+    def link(self):
+        link = tuple.__getitem__(self, 2)
+        return link if isinstance(link, FilterLink) else None
+
+    @property
+    def params(self):
+        params = tuple.__getitem__(self, 2)
+        if isinstance(params, FilterLink):
+            params = self.__dict__.get('_params')
+            if params is None:
+                params = self._params = self.link.get_params()
+        return params
+
+    @property
+    def query(self):
+        """
+        The params as a querystring, or None.
+        """
+        source = tuple.__getitem__(self, 2)
+        if source is None:
+            return None
+        return source.urlencode()
+
+    def get_paramlist(self, query_param):
+        """
+        Returns the values of query_param in params.
+        """
+        source = tuple.__getitem__(self, 2)
+        if isinstance(source, FilterLink):
+            return list(source.paramlist)
+        if source is None:
+            return None
+        return source.getlist(query_param)
+
+    def __iter__(self):
+        label, count, _, link_type = tuple.__iter__(self)
+        return iter((label, count, self.params, link_type))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __getslice__(self, i, j):
+        # Python 2 only
+        return tuple(self)[i:j]
+
+    def __eq__(self, other):
+        return isinstance(other, tuple) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'FilterChoice(label=%r, count=%r, params=%r, link_type=%r)' % tuple(self)
+
+    def __getnewargs__(self):
+        return tuple(self) + (self.is_estimate, self.is_capped)
+
+    def _replace(self, **kwargs):
+        values = dict(zip(self._fields, tuple.__iter__(self)),
+                      is_estimate=self.is_estimate, is_capped=self.is_capped)
+        values.update(kwargs)
+        return self.__class__(**values)
 
 
 FILTER_ADD = 'add'
 FILTER_REMOVE = 'remove'
 FILTER_DISPLAY = 'display'
 
+# The number of values looked up in each query for labels of related objects,
+# which keeps the IN clause within what the DB accepts.
+LABELS_PER_QUERY = 500
+
 
 class Filter(object):
     """
     A Filter creates links/URLs that correspond to some DB filtering,
     and can apply the information from a URL to filter a QuerySet.
     """
+    # Whether FilterSet.disjunctive_counts can be used, i.e. whether the counts
+    # still make sense when the filter's own choices are not applied to the
+    # QuerySet passed to get_choices.
+    allows_disjunctive_counts = True
 
     # -- Public interface --
 
-    def __init__(self, field, model, params, query_param=None, order_by_count=False):
+    def __init__(self, field, model, params, query_param=None, order_by_count=False,
+                 max_choices=None, approximate=None, approximate_threshold=10000,
+                 count_cap=None):
         self.field = field
         self.model = model
         self.params = params
@@ -57,11 +170,27 @@ class Filter(object):
             query_param = field
         self.query_param = query_param
         self.order_by_count = order_by_count
-        self.field_obj = self.model._meta.get_field(self.field)
+        self.max_choices = max_choices
+        # Set to True by get_choices if max_choices stopped some choices being
+        # returned.
+        self.more_choices = False
+        self.approximate = approximate
+        self.approximate_threshold = approximate_threshold
+        # Set to True when counts are estimated from a sample.
+        self.counts_estimated = False
+        # Statistics for the whole table from the django_easyfilters.stats
+        # catalogue, if FilterSet.use_field_stats is set.
+        self.field_stats = None
+        # A callable like queries.count_at_most, which a FilterSet sets so
+        # that each QuerySet is only counted once for all its filters.
+        self.count_rows_at_most = None
+        self.count_cap = count_cap
+        self.field_info = self.get_field_info(model, field)
+        self.field_obj = self.field_info['field_obj']
 
         if self.field_obj.rel is not None:
-            self.rel_model = self.field_obj.rel.to
-            self.rel_field = self.field_obj.rel.get_related_field()
+            self.rel_model = self.field_info['rel_model']
+            self.rel_field = self.field_info['rel_field']
         # Make chosen an immutable sequence, to stop accidental mutation.
         self.chosen = tuple(self.choices_from_params())
 
@@ -83,6 +212,146 @@ class Filter(object):
         """
         raise NotImplementedError()
 
+    def has_choices(self, qs):
+        """
+        Returns True if get_choices(qs) would return any choices. Subclasses
+        override this to use a cheaper query where possible.
+        """
+        return len(self.get_choices(qs)) > 0
+
+    def prefetch_counts(self, qs, batch):
+        """
+        Adds the count queries that get_choices(qs) will need to the FacetBatch
+        'batch', so that they can be run in a single statement with those of
+        other filters. Filters that can't do this just don't add anything.
+        """
+        pass
+
+    def prefetch_disjunctive_counts(self, qs, batch, base_qs, conditions):
+        """
+        Like prefetch_counts(qs, batch), where qs is base_qs filtered by each of
+        the QuerySets in 'conditions' (see FilterSet.disjunctive_counts). The
+        counts are found from base_qs using conditional aggregation, so that
+        the queries for all filters are over the same rows.
+        """
+        pass
+
+    def get_choices_page(self, qs, limit, offset=0, prefix=None, after=None):
+        """
+        Returns a page of the choices that add a value to the filter, ignoring
+        max_choices, as a tuple (choices, more), where 'more' is True if there
+        are further pages. This allows the choices of large filters to be
+        loaded incrementally.
+
+        The choices are in the same order as for get_choices. If 'prefix' is
+        given, only choices with labels that start with it (ignoring case) are
+        included. The page starts at 'offset', or if 'after' is given, after
+        the choice for that value of the query parameter, which should be the
+        last value of the previous page, as returned by choice_value_param().
+        ValueError is raised if 'after' is not found.
+
+        Where possible, the page is selected by the database, using
+        query_choices_page(). Otherwise all the choices are built, and the page
+        is selected from them.
+        """
+        page = self.query_choices_page(qs, limit, offset, prefix, after)
+        if page is not None:
+            return page
+        max_choices, more_choices = self.max_choices, self.more_choices
+        self.max_choices = None
+        try:
+            choices = [c for c in self.get_choices(qs) if c.link_type == FILTER_ADD]
+        finally:
+            self.max_choices, self.more_choices = max_choices, more_choices
+        return self.select_choices_page(choices, limit, offset, prefix, after)
+
+    def select_choices_page(self, choices, limit, offset, prefix, after):
+        """
+        Returns the result of get_choices_page() given a list of all the 'add'
+        choices.
+        """
+        if prefix:
+            prefix = prefix.lower()
+            choices = [c for c in choices
+                       if six.text_type(c.label).lower().startswith(prefix)]
+        if after is not None:
+            for i, c in enumerate(choices):
+                if self.choice_value_param(c) == after:
+                    offset += i + 1
+                    break
+            else:
+                raise ValueError("Choice %r not found" % after)
+        return choices[offset:offset + limit], len(choices) > offset + limit
+
+    def query_choices_page(self, qs, limit, offset, prefix, after):
+        """
+        Returns the result of get_choices_page() using queries that only fetch
+        the choices in the page, or None if the filter can't do this.
+        """
+        return None
+
+    def get_rows_page(self, rows, ordering, limit, offset=0, after_values=None,
+                      after_count=None):
+        """
+        Returns a page of 'rows', a values QuerySet annotated with
+        easyfilter_count, as a tuple (list of rows, more). The rows are ordered
+        by 'ordering', which must identify a row uniquely, after the counts if
+        order_by_count is True. The page starts at 'offset', after the row
+        whose values for 'ordering' are 'after_values', and whose count is
+        'after_count', if these are given.
+        """
+        if self.order_by_count:
+            ordered = rows.order_by(*['-easyfilter_count'] + ordering)
+        else:
+            ordered = rows.order_by(*ordering)
+        stop = offset + limit + 1
+        if after_values is None:
+            page = list(ordered[offset:stop])
+        elif self.order_by_count:
+            # The rows with the same count that come after it, and then the
+            # rows with lower counts. (The count is in the HAVING clause, so
+            # the two can't be combined with OR.)
+            keyset = keyset_lookup(ordering, after_values)
+            page = list(ordered.filter(keyset).filter(easyfilter_count=after_count)[:stop])
+            if len(page) < stop:
+                page.extend(ordered.filter(easyfilter_count__lt=after_count)[:stop - len(page)])
+            page = page[offset:]
+        else:
+            page = list(ordered.filter(keyset_lookup(ordering, after_values))[offset:stop])
+        return page[:limit], len(page) > limit
+
+    def choice_value_param(self, choice):
+        """
+        Returns the value of the query parameter that the 'add' choice adds.
+        """
+        return choice.get_paramlist(self.query_param)[-1]
+
+    # {(filter class, model, field): dictionary}, see get_field_info()
+    _field_info_cache = {}
+
+    @classmethod
+    def get_field_info(cls, model, field):
+        """
+        Returns a dictionary of information about the field that doesn't depend
+        on the request. It is computed once for each filter class, model and
+        field, using make_field_info().
+        """
+        key = (cls, model, field)
+        try:
+            return Filter._field_info_cache[key]
+        except KeyError:
+            info = Filter._field_info_cache[key] = cls.make_field_info(model, field)
+            return info
+
+    @classmethod
+    def make_field_info(cls, model, field):
+        field_obj = model._meta.get_field(field)
+        info = {'field_obj': field_obj}
+        if field_obj.rel is not None:
+            info['rel_model'] = field_obj.rel.to
+            info['rel_field'] = field_obj.rel.get_related_field()
+        return info
+
     # -- Methods that are used by base implementation above --
 
     def choices_from_params(self):
@@ -114,6 +383,19 @@ class Filter(object):
 
     # -- Utility methods needed by most/all subclasses --
 
+    def set_prefetched(self, qs, **results):
+        self._prefetched = (qs, results)
+
+    def get_prefetched(self, qs, name):
+        """
+        Returns the result called 'name' of a FacetBatch query that was added
+        by prefetch_counts for the same QuerySet, or None.
+        """
+        prefetched = getattr(self, '_prefetched', None)
+        if prefetched is None or prefetched[0] is not qs or name not in prefetched[1]:
+            return None
+        return prefetched[1][name].value
+
     def param_from_choice(self, choice):
         return six.text_type(choice)
 
@@ -129,7 +411,13 @@ class Filter(object):
         add is an optional item to add,
         remove is an option list of items to remove.
         """
-        params = self.params.copy()
+        return self.build_link(add=add, remove=remove).get_params()
+
+    def build_link(self, add=None, remove=None):
+        """
+        As for build_params, but returns a FilterLink, which is cheaper if the
+        parameters are not used, or are only needed as a querystring.
+        """
         chosen = list(self.chosen)
         if remove is not None:
             for r in remove:
@@ -137,13 +425,168 @@ class Filter(object):
         else:
             if add not in chosen:
                 chosen.append(add)
-        if chosen:
-            params.setlist(self.query_param, self.paramlist_from_choices(chosen))
+        return FilterLink(self, self.paramlist_from_choices(chosen))
+
+    def params_from_paramlist(self, paramlist):
+        """
+        Builds a new parameter MultiDict, with the parameter for this filter set
+        to paramlist.
+        """
+        params = self.params.copy()
+        if paramlist:
+            params.setlist(self.query_param, paramlist)
         else:
-            del params[self.query_param]
+            params.pop(self.query_param, None)
         params.pop('page', None)  # links should reset paging
         return params
 
+    def urlencode_paramlist(self, paramlist):
+        """
+        Returns params_from_paramlist(paramlist) as a querystring.
+        """
+        # The rest of the querystring is the same for every choice, so it is
+        # only encoded once.
+        base = getattr(self, '_base_query', None)
+        if base is None:
+            base = self._base_query = self.encode_params(self.params_from_paramlist([]))
+        if not paramlist:
+            return base
+        query = self.encode_params({self.query_param: paramlist})
+        return base + '&' + query if base else query
+
+    def encode_params(self, params):
+        # params can be a MultiValueDict, or a dictionary of lists.
+        query = QueryDict('', mutable=True)
+        for key in params:
+            query.setlist(key, params.getlist(key) if hasattr(params, 'getlist') else params[key])
+        return query.urlencode()
+
+    def count_limit(self):
+        """
+        Returns the number of values to fetch when getting counts, which is one
+        more than max_choices, so that we know if there are more, or None.
+        """
+        if self.max_choices is None:
+            return None
+        return self.max_choices + 1
+
+    def limit_counts(self, count_dict):
+        """
+        Applies max_choices to a dictionary of {value: count}, keeping the
+        values with the highest counts if order_by_count is True, and sets
+        more_choices.
+        """
+        self.more_choices = False
+        if self.max_choices is None or len(count_dict) <= self.max_choices:
+            return count_dict
+        self.more_choices = True
+        items = list(count_dict.items())
+        if self.order_by_count:
+            items.sort(key=operator.itemgetter(1), reverse=True)
+        limited = SortedDict()
+        for val, count in items[:self.max_choices]:
+            limited[val] = count
+        return limited
+
+    def get_sample_modulus(self, qs):
+        """
+        Returns the modulus for sample_queryset if the counts for qs should be
+        estimated from a sample, or None if they should be exact.
+        """
+        if self.approximate is None or not can_sample(qs.model):
+            return None
+        sample = getattr(self, '_sample', None)
+        if sample is None or sample[0] is not qs:
+            # Small result sets are counted exactly.
+            threshold = self.approximate_threshold
+            count_rows = self.count_rows_at_most or count_at_most
+            if count_rows(qs, threshold + 1) <= threshold:
+                modulus = None
+            else:
+                modulus = self.approximate
+            sample = self._sample = (qs, modulus)
+        return sample[1]
+
+    def get_counts_sample(self, qs):
+        """
+        Returns a tuple (QuerySet, modulus), where the QuerySet is qs, or a
+        sample of it if counts are being estimated, and the counts found from
+        it should be multiplied by modulus.
+        """
+        modulus = self.get_sample_modulus(qs)
+        self.counts_estimated = modulus is not None
+        if modulus is None:
+            return qs, 1
+        return sample_queryset(qs, modulus), modulus
+
+    def get_sampled_counts_qs(self, qs):
+        """
+        Returns a tuple (QuerySet, field name, modulus), like get_counts_qs()
+        for a sample of qs if counts are being estimated, where the counts
+        found should be multiplied by modulus.
+        """
+        sample_qs, modulus = self.get_counts_sample(qs)
+        counts_qs, field_name = self.get_counts_qs(sample_qs)
+        return counts_qs, field_name, modulus
+
+    def query_values_counts(self, qs):
+        """
+        Runs the query for the counts of the values of the field returned by
+        get_counts_qs(qs), as a SortedDict of {value: count}, applying the
+        count_cap and approximate options.
+        """
+        if self.count_cap is not None:
+            counts_qs, field_name = self.get_counts_qs(qs)
+            candidates = self.get_count_candidates()
+            if candidates is not None and not self.order_by_count:
+                count_dict = capped_value_counts(counts_qs, field_name, self.count_cap,
+                                                 candidates, limit=self.count_limit())
+                if count_dict is not None:
+                    return count_dict
+            # The values can only be found from the rows, too few of the
+            # candidates occur, or the counts are needed in full for sorting,
+            # so a normal count query is best. mark_counts() caps the counts
+            # for display.
+            return value_counts(counts_qs, field_name,
+                                order_by_count=self.order_by_count,
+                                limit=self.count_limit())
+        counts_qs, field_name, modulus = self.get_sampled_counts_qs(qs)
+        return scale_counts(value_counts(counts_qs, field_name,
+                                         order_by_count=self.order_by_count,
+                                         limit=self.count_limit()),
+                            modulus)
+
+    def get_count_candidates(self):
+        """
+        Returns the values that the field can have, in order, as a list or a
+        QuerySet that doesn't depend on the rows being counted, for use with
+        count_cap, or None if they are not known.
+        """
+        return None
+
+    def can_batch_counts(self):
+        """
+        Returns True if the counts for the filter can be fetched by a FacetBatch
+        query, which is not possible for estimated or capped counts.
+        """
+        return self.approximate is None and self.count_cap is None
+
+    def mark_counts(self, choices):
+        """
+        Sets is_estimate and is_capped on the choices as needed.
+        """
+        for i, c in enumerate(choices):
+            if c.count is None:
+                continue
+            changes = {}
+            if self.counts_estimated:
+                changes['is_estimate'] = True
+            if self.count_cap is not None and c.count > self.count_cap:
+                changes.update(count=self.count_cap, is_capped=True)
+            if changes:
+                choices[i] = c._replace(**changes)
+        return choices
+
     def sort_choices(self, qs, choices):
         """
         Sorts the choices by applying order_by_count if applicable.
@@ -163,7 +606,7 @@ class Filter(object):
         for choice in chosen:
             choices.append(FilterChoice(self.render_choice_object(choice),
                                         None,  # Don't need count for removing
-                                        self.build_params(remove=[choice]),
+                                        self.build_link(remove=[choice]),
                                         FILTER_REMOVE))
         return choices
 
@@ -203,17 +646,32 @@ class ChooseOnceMixin(SingleValueMixin):
     A mixin for filters where you can only choose the filter once, and then
     remove the filter.
     """
+    # Once chosen, there are no counts to show.
+    allows_disjunctive_counts = False
+
     def get_choices(self, qs):
         choices_remove = self.get_choices_remove(qs)
         if len(choices_remove) > 0:
             return choices_remove
         else:
             choices_add = self.normalize_add_choices(self.get_choices_add(qs))
-            return self.sort_choices(qs, choices_add)
+            return self.sort_choices(qs, self.mark_counts(choices_add))
 
     def get_choices_add(self, qs):
         raise NotImplementedError()
 
+    def get_choices_page(self, qs, limit, offset=0, prefix=None, after=None):
+        if len(self.chosen) > 0:
+            # Only 'remove' choices
+            return [], False
+        return super(ChooseOnceMixin, self).get_choices_page(qs, limit, offset=offset,
+                                                            prefix=prefix, after=after)
+
+    def prefetch_counts(self, qs, batch):
+        # Counts are only needed for 'add' choices
+        if len(self.chosen) == 0:
+            super(ChooseOnceMixin, self).prefetch_counts(qs, batch)
+
 
 class ChooseAgainMixin(object):
     """
@@ -226,20 +684,245 @@ class ChooseAgainMixin(object):
         # links, and multiple add links, at the same time.
         choices_remove = self.get_choices_remove(qs)
         choices_add = self.normalize_add_choices(self.get_choices_add(qs))
-        choices_add = self.sort_choices(qs, choices_add)
+        choices_add = self.sort_choices(qs, self.mark_counts(choices_add))
         return choices_remove + choices_add
 
 
 class RelatedObjectMixin(object):
     """
-    Mixin for fields that need to validate params against related field.
+    Mixin for fields that need to validate params against related field, and
+    display related objects.
     """
+    def __init__(self, *args, **kwargs):
+        self.join_related = kwargs.pop('join_related', True)
+        self.label_fields = kwargs.pop('label_fields', None)
+        self.label_func = kwargs.pop('label_func', None)
+        self.label_cache_size = kwargs.pop('label_cache_size', None)
+        super(RelatedObjectMixin, self).__init__(*args, **kwargs)
+
     def choice_from_param(self, param):
         try:
             return self.rel_field.to_python(param)
         except ValidationError:
             raise ValueError()
 
+    def choice_from_value(self, value):
+        """
+        Converts a value of the related field (as found in the DB) into a
+        choice.
+        """
+        return value
+
+    def get_related_choices_add(self, qs):
+        return [FilterChoice(label,
+                             count,
+                             self.build_link(add=self.choice_from_value(value)),
+                             FILTER_ADD)
+                for value, label, count in self.get_labels_counts(qs)]
+
+    # Labels for related objects are produced either from the related object
+    # (constructed from the fields in get_label_names()), or from a dictionary
+    # of those field values if label_func is used.
+
+    def get_label_names(self):
+        """
+        Returns the names of the fields of the related model that are needed
+        to produce labels.
+        """
+        if self.label_fields is None:
+            opts = self.rel_model._meta
+            names = [f.name for f in getattr(opts, 'concrete_fields', opts.fields)]
+        else:
+            names = list(self.label_fields)
+        if self.rel_field.name not in names:
+            names.insert(0, self.rel_field.name)
+        return names
+
+    def get_related_ordering(self):
+        opts = self.rel_model._meta
+        return [o for o in opts.ordering or [opts.pk.name] if o != '?']
+
+    def label_from_row(self, row):
+        """
+        Returns the label for a related object, given a dictionary of the values
+        of the fields in get_label_names()
+        """
+        if self.label_func is not None:
+            return self.label_func(row)
+        opts = self.rel_model._meta
+        fields = getattr(opts, 'concrete_fields', opts.fields)
+        # Fields that weren't fetched are deferred, as with QuerySet.only(), so
+        # that they are loaded if they are used rather than having defaults.
+        skip = frozenset(f.attname for f in fields if f.name not in row)
+        if skip:
+            model = deferred_class_factory(self.rel_model, skip)
+        else:
+            model = self.rel_model
+        obj = model(**dict((f.attname, row[f.name]) for f in fields if f.name in row))
+        obj._state.adding = False
+        obj._state.db = self.rel_model._default_manager.db
+        return self.render_choice_object(obj)
+
+    def get_label_cache(self):
+        if self.label_cache_size is None:
+            return None
+        key = (self.__class__, self.model, self.field,
+               tuple(self.label_fields or ()), self.label_func)
+        return cache.get_label_cache(key, self.rel_model, self.rel_field.attname,
+                                     self.label_cache_size)
+
+    def get_labels(self, values):
+        """
+        Returns a dictionary of {value: (label, ordering)} for the values of the
+        related field, where 'ordering' is a list of the values of the fields in
+        get_related_ordering(). Values that don't exist in the DB are missing.
+        """
+        label_cache = self.get_label_cache()
+        if label_cache is None:
+            found = {}
+        else:
+            found = label_cache.get_many(values)
+        missing = [v for v in values if v not in found]
+        if missing:
+            names = self.get_label_names()
+            ordering_names = [o.lstrip('-') for o in self.get_related_ordering()]
+            labels = {}
+            for start in range(0, len(missing), LABELS_PER_QUERY):
+                lookup = {self.rel_field.name + '__in': missing[start:start + LABELS_PER_QUERY]}
+                rows = (self.rel_model.objects.filter(**lookup)
+                        .values(*(names + [n for n in ordering_names if n not in names])))
+                labels.update((row[self.rel_field.name],
+                               (self.label_from_row(row), [row[n] for n in ordering_names]))
+                              for row in rows)
+            if label_cache is not None:
+                label_cache.set_many(labels)
+            found.update(labels)
+        return found
+
+    def get_labels_counts(self, qs):
+        """
+        Returns a list of (value, label, count) for the related objects that
+        can be chosen, where 'value' is the value of the related field.
+        """
+        if (self.label_cache_size is not None or not self.join_related or
+                self.count_cap is not None or self.get_prefetched(qs, 'counts') is not None):
+            return self.get_sorted_labels_counts(qs)
+
+        names = self.get_label_names()
+        counts_qs, field_name, modulus = self.get_sampled_counts_qs(qs)
+        # Get the label fields and counts in a single query, by joining to
+        # the related table and aggregating.
+        prefix = field_name + '__'
+        ordering = [('-' + prefix + o[1:]) if o.startswith('-') else (prefix + o)
+                    for o in self.get_related_ordering()]
+        rows = (counts_qs
+                .values(*[prefix + n for n in names])
+                .order_by(*ordering)
+                .annotate(easyfilter_count=models.Count(field_name)))
+        limit = self.count_limit()
+        if limit is not None:
+            rows = rows.filter(**{field_name + '__isnull': False})
+            if self.order_by_count:
+                rows = rows.order_by(*['-easyfilter_count'] + ordering)
+            rows = list(rows[:limit])
+            self.more_choices = len(rows) > self.max_choices
+            rows = rows[:self.max_choices]
+        return [(row[prefix + self.rel_field.name],
+                 self.label_from_row(dict((n, row[prefix + n]) for n in names)),
+                 row['easyfilter_count'] * modulus)
+                for row in rows
+                if row[prefix + self.rel_field.name] is not None]
+
+    def get_count_candidates(self):
+        if self.max_choices is None:
+            # The related table could be large, and every row would be counted.
+            return None
+        # In the same order as the choices, so the first max_choices found
+        # are the ones that would be shown.
+        ordering = self.get_related_ordering() + [self.rel_field.name]
+        return (self.rel_model._default_manager
+                .order_by(*ordering)
+                .values_list(self.rel_field.name, flat=True))
+
+    def get_label_search_field(self):
+        """
+        Returns the name of the field of the related model that is matched
+        against the prefix in get_choices_page(), which is the first of
+        label_fields, or else the first text field that the related model is
+        ordered by, or None.
+        """
+        if self.label_fields:
+            return self.label_fields[0]
+        name = self.get_related_ordering()[0].lstrip('-')
+        try:
+            field = self.rel_model._meta.get_field(name)
+        except models.FieldDoesNotExist:
+            return None
+        if isinstance(field, (models.CharField, models.TextField)):
+            return name
+        return None
+
+    def query_choices_page(self, qs, limit, offset, prefix, after):
+        search_field = self.get_label_search_field()
+        if prefix and search_field is None:
+            return None
+        ordering = self.get_related_ordering()
+        if self.rel_field.name not in [o.lstrip('-') for o in ordering]:
+            # Needed to make the order unique.
+            ordering = ordering + [self.rel_field.name]
+        after_values = after_count = None
+        if after is not None:
+            value = self.choice_from_param(after)
+            found = (self.rel_model.objects
+                     .filter(**{self.rel_field.name: value})
+                     .values_list(*[o.lstrip('-') for o in ordering]))
+            if not found:
+                raise ValueError("Choice %r not found" % after)
+            after_values = list(found[0])
+            if None in after_values:
+                # NULL can't be compared in SQL
+                return None
+
+        counts_qs, field_name, modulus = self.get_sampled_counts_qs(qs)
+        rel_prefix = field_name + '__'
+        if prefix:
+            counts_qs = counts_qs.filter(**{rel_prefix + search_field + '__istartswith': prefix})
+        if after is not None and self.order_by_count:
+            after_count = counts_qs.filter(**{field_name: value}).count()
+            if after_count == 0:
+                raise ValueError("Choice %r not found" % after)
+        names = self.get_label_names()
+        rows = (counts_qs
+                .filter(**{field_name + '__isnull': False})
+                .values(*[rel_prefix + n for n in names])
+                .annotate(easyfilter_count=models.Count(field_name)))
+        rows, more = self.get_rows_page(rows,
+                                        [('-' + rel_prefix + o[1:]) if o.startswith('-')
+                                         else (rel_prefix + o)
+                                         for o in ordering],
+                                        limit, offset, after_values, after_count)
+        choices = [FilterChoice(self.label_from_row(dict((n, row[rel_prefix + n]) for n in names)),
+                                row['easyfilter_count'] * modulus,
+                                self.build_link(add=self.choice_from_value(
+                                    row[rel_prefix + self.rel_field.name])),
+                                FILTER_ADD)
+                   for row in rows]
+        return self.mark_counts(choices), more
+
+    def get_sorted_labels_counts(self, qs):
+        # The counts are found separately (or were prefetched), and labels come
+        # from get_labels() in bounded queries, or from the label cache where
+        # possible, so they have to be sorted here rather than in the DB.
+        count_dict = self.get_values_counts(qs)
+        labels = self.get_labels([v for v in count_dict.keys() if v is not None])
+        items = [(value, labels[value], count) for value, count in count_dict.items()
+                 if value in labels]
+        ordering = self.get_related_ordering()
+        for i in reversed(range(len(ordering))):
+            items.sort(key=lambda item: (item[1][1][i] is None, item[1][1][i]),
+                       reverse=ordering[i].startswith('-'))
+        return [(value, label, count) for value, (label, _), count in items]
+
 
 class SimpleQueryMixin(object):
     """
@@ -252,11 +935,89 @@ class SimpleQueryMixin(object):
         The order is the underlying order produced by sorting ascending on the
         DB field.
         """
-        return value_counts(qs, self.field)
+        count_dict = self.get_prefetched(qs, 'counts')
+        if count_dict is None:
+            count_dict = self.query_values_counts(qs)
+        return self.limit_counts(count_dict)
+
+    def prefetch_counts(self, qs, batch):
+        if self.can_batch_counts():
+            self.set_prefetched(qs, counts=batch.value_counts(qs, self.field))
+
+    def prefetch_disjunctive_counts(self, qs, batch, base_qs, conditions):
+        if self.can_batch_counts():
+            self.set_prefetched(qs, counts=batch.value_counts(base_qs, self.field, 'pk',
+                                                              conditions))
+
+    def get_counts_qs(self, qs):
+        return qs, self.field
+
+
+EMPTY_RANGE = object()
+
+RANGE_LOWER_LOOKUPS = {'__gt': False, '__gte': True}
+RANGE_UPPER_LOOKUPS = {'__lt': False, '__lte': True}
+
+
+def intersect_range_lookups(field_name, lookups):
+    """
+    Combines a list of lookup dictionaries for field_name, each using only
+    exact, __gt(e) and __lt(e) lookups, into a single lookup dictionary for
+    the values that match all of them. Returns EMPTY_RANGE if no values can
+    match, or None if the lookups can't be combined.
+    """
+    exact = []
+    lower = upper = None  # (value, inclusive)
+    for lookup in lookups:
+        for key, value in lookup.items():
+            if not key.startswith(field_name):
+                return None
+            suffix = key[len(field_name):]
+            if suffix == '':
+                exact.append(value)
+            elif suffix in RANGE_LOWER_LOOKUPS:
+                inclusive = RANGE_LOWER_LOOKUPS[suffix]
+                if (lower is None or value > lower[0] or
+                        (value == lower[0] and not inclusive)):
+                    lower = (value, inclusive)
+            elif suffix in RANGE_UPPER_LOOKUPS:
+                inclusive = RANGE_UPPER_LOOKUPS[suffix]
+                if (upper is None or value < upper[0] or
+                        (value == upper[0] and not inclusive)):
+                    upper = (value, inclusive)
+            else:
+                return None
+
+    def in_range(value):
+        if lower is not None and (value < lower[0] or
+                                  (value == lower[0] and not lower[1])):
+            return False
+        if upper is not None and (value > upper[0] or
+                                  (value == upper[0] and not upper[1])):
+            return False
+        return True
+
+    if exact:
+        if any(v != exact[0] for v in exact) or not in_range(exact[0]):
+            return EMPTY_RANGE
+        return {field_name: exact[0]}
+    if lower is not None and upper is not None:
+        if (lower[0] > upper[0] or
+                (lower[0] == upper[0] and not (lower[1] and upper[1]))):
+            return EMPTY_RANGE
+    lookup = {}
+    if lower is not None:
+        lookup[field_name + ('__gte' if lower[1] else '__gt')] = lower[0]
+    if upper is not None:
+        lookup[field_name + ('__lte' if upper[1] else '__lt')] = upper[0]
+    return lookup
 
 
 class RangeFilterMixin(ChooseAgainMixin):
 
+    # The choices for drilling down depend on the range that is chosen.
+    allows_disjunctive_counts = False
+
     # choice_type must be set to a class that provides the static method
     # 'from_param' and instance methods 'make_lookup' and 'display', and the
     # __cmp__ and __eq__ methods for sorting.
@@ -273,6 +1034,18 @@ class RangeFilterMixin(ChooseAgainMixin):
     def lookup_from_choice(self, choice):
         return choice.make_lookup(self.field)
 
+    def apply_filter(self, qs):
+        # With drill down, the chosen ranges are nested, so they are reduced to
+        # a single range, to keep the SQL simple.
+        lookups = [self.lookup_from_choice(c) for c in self.chosen]
+        lookup = intersect_range_lookups(self.field, lookups)
+        if lookup is None:
+            # Can't be combined
+            return super(RangeFilterMixin, self).apply_filter(qs)
+        if lookup is EMPTY_RANGE:
+            return qs.none()
+        return qs.filter(**lookup)
+
     def get_choices_remove(self, qs):
         # Due to drill down, if a broader param is removed, the more specific
         # params must be removed too. We assume we can do an ordering on
@@ -284,7 +1057,7 @@ class RangeFilterMixin(ChooseAgainMixin):
             to_remove = [c for c in chosen if c >= choice]
             out.append(FilterChoice(self.render_choice_object(choice),
                                     None,
-                                    self.build_params(remove=to_remove),
+                                    self.build_link(remove=to_remove),
                                     FILTER_REMOVE))
         return out
 
@@ -302,6 +1075,10 @@ class ValuesFilter(ChooseOnceMixin, SimpleQueryMixin, Filter):
         else:
             return retval
 
+    def has_choices(self, qs):
+        # Every value, including NULL, gives a choice.
+        return len(self.chosen) > 0 or qs.exists()
+
     def get_choices_add(self, qs):
         """
         Called by 'get_choices', this is usually the one to override.
@@ -309,10 +1086,36 @@ class ValuesFilter(ChooseOnceMixin, SimpleQueryMixin, Filter):
         count_dict = self.get_values_counts(qs)
         return [FilterChoice(self.render_choice_object(val),
                              count,
-                             self.build_params(add=val),
+                             self.build_link(add=val),
                              FILTER_ADD)
                 for val, count in count_dict.items()]
 
+    def query_choices_page(self, qs, limit, offset, prefix, after):
+        if prefix and not isinstance(self.field_obj, (models.CharField, models.TextField)):
+            # Only text is displayed as it is stored, so that the prefix can
+            # be matched by the database.
+            return None
+        counts_qs, field_name, modulus = self.get_sampled_counts_qs(qs)
+        if prefix:
+            counts_qs = counts_qs.filter(**{field_name + '__istartswith': prefix})
+        after_values = after_count = None
+        if after is not None:
+            value = self.choice_from_param(after)
+            after_values = [value]
+            if self.order_by_count:
+                after_count = counts_qs.filter(**{field_name: value}).count()
+                if after_count == 0:
+                    raise ValueError("Choice %r not found" % after)
+        rows = counts_qs.values(field_name).annotate(easyfilter_count=models.Count(field_name))
+        rows, more = self.get_rows_page(rows, [field_name], limit, offset,
+                                        after_values, after_count)
+        choices = [FilterChoice(self.render_choice_object(row[field_name]),
+                                row['easyfilter_count'] * modulus,
+                                self.build_link(add=row[field_name]),
+                                FILTER_ADD)
+                   for row in rows]
+        return self.mark_counts(choices), more
+
 
 class ChoicesFilter(ValuesFilter):
     """
@@ -324,7 +1127,20 @@ class ChoicesFilter(ValuesFilter):
     # 3) make display value = the second element in choices' tuples.
     def __init__(self, *args, **kwargs):
         super(ChoicesFilter, self).__init__(*args, **kwargs)
-        self.choices_dict = dict(self.field_obj.flatchoices)
+        self.choices_dict = self.field_info['choices_dict']
+
+    @classmethod
+    def make_field_info(cls, model, field):
+        info = super(ChoicesFilter, cls).make_field_info(model, field)
+        info['choices_dict'] = dict(info['field_obj'].flatchoices)
+        return info
+
+    def has_choices(self, qs):
+        return (len(self.chosen) > 0 or
+                qs.filter(**{self.field + '__in': list(self.choices_dict.keys())}).exists())
+
+    def get_count_candidates(self):
+        return [val for val, display in self.field_obj.flatchoices]
 
     def render_choice_object(self, choice):
         # 3) above
@@ -338,55 +1154,150 @@ class ChoicesFilter(ValuesFilter):
             if val in count_dict:
                 choices.append(FilterChoice(self.render_choice_object(val),
                                             count_dict[val],
-                                            self.build_params(add=val),
+                                            self.build_link(add=val),
                                             FILTER_ADD))
         return choices
 
+    def query_choices_page(self, qs, limit, offset, prefix, after):
+        # The labels are known in advance, so only the values whose labels
+        # match the prefix need counting, and there can't be many of them.
+        values = [val for val, display in self.field_obj.choices
+                  if not prefix or six.text_type(display).lower().startswith(prefix.lower())]
+        count_dict = {}
+        if values:
+            sample_qs, modulus = self.get_counts_sample(qs)
+            count_dict = scale_counts(value_counts(sample_qs.filter(**{self.field + '__in': values}),
+                                                   self.field),
+                                      modulus)
+        choices = [FilterChoice(self.render_choice_object(val),
+                                count_dict[val],
+                                self.build_link(add=val),
+                                FILTER_ADD)
+                   for val in values if val in count_dict]
+        choices = self.sort_choices(qs, self.mark_counts(choices))
+        return self.select_choices_page(choices, limit, offset, None, after)
+
 
 class ForeignKeyFilter(ChooseOnceMixin, SimpleQueryMixin, RelatedObjectMixin, Filter):
     """
     Filter for ForeignKey fields.
     """
-    def choice_from_param(self, param):
-        choice_pk = super(ForeignKeyFilter, self).choice_from_param(param)
-        lookup = {self.rel_field.name: choice_pk}
-        try:
-            obj = self.rel_model.objects.get(**lookup)
-        except self.rel_model.DoesNotExist:
-            raise ValueError("object does not exist in DB")
-        return obj
+    # The chosen values are kept as the values of the related field (normally
+    # the PK), which is all that is needed for filtering. The related objects
+    # are only looked up when they are needed for display.
 
-    def param_from_choice(self, choice):
-        return six.text_type(choice.pk)
+    def lookup_from_choice(self, choice):
+        return {self.field_obj.attname: choice}
 
-    def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        lookup = {self.rel_field.name + '__in': count_dict.keys()}
-        objs = self.rel_model.objects.filter(**lookup)
-        choices = []
+    def has_choices(self, qs):
+        if len(self.chosen) > 0:
+            return True
+        return qs.filter(**{self.field + '__isnull': False}).exists()
 
-        for o in objs:
-            pk = getattr(o, self.rel_field.attname)
-            choices.append(FilterChoice(self.render_choice_object(o),
-                                        count_dict[pk],
-                                        self.build_params(add=o),
-                                        FILTER_ADD))
-        return choices
+    def get_choices_remove(self, qs):
+        if not hasattr(self, '_chosen_labels'):
+            self._chosen_labels = self.get_labels(list(self.chosen)) if self.chosen else {}
+        # The filter is applied without looking up the chosen objects, so one
+        # that doesn't exist (e.g. it has been deleted) still needs a link to
+        # remove it, labelled with the value from the query string.
+        return [FilterChoice(self._chosen_labels[choice][0]
+                             if choice in self._chosen_labels
+                             else self.param_from_choice(choice),
+                             None,
+                             self.build_link(remove=[choice]),
+                             FILTER_REMOVE)
+                for choice in self.chosen]
+
+    def get_choices_add(self, qs):
+        return self.get_related_choices_add(qs)
 
 
 class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
 
+    def __init__(self, *args, **kwargs):
+        # 'all' to find items related to all of the chosen objects, 'any' to
+        # find items related to any of them.
+        self.match = kwargs.pop('match', 'all')
+        assert self.match in ['all', 'any']
+        super(ManyToManyFilter, self).__init__(*args, **kwargs)
+
+    @property
+    def allows_disjunctive_counts(self):
+        # With 'all', choosing another object narrows the results that the
+        # counts were calculated from, so they must include this filter.
+        return self.match == 'any'
+
+    @classmethod
+    def make_field_info(cls, model, field):
+        info = super(ManyToManyFilter, cls).make_field_info(model, field)
+        through = info['field_obj'].rel.through
+        # For a relation from a model to itself, these are the same, so they
+        # can't be used.
+        info['fkey_this'] = [f for f in through._meta.fields
+                             if f.rel is not None and f.rel.to is model][0]
+        info['fkey_other'] = [f for f in through._meta.fields
+                              if f.rel is not None and f.rel.to is info['rel_model']][0]
+        return info
+
+    def get_through_fields(self):
+        """
+        Returns the intermediate model, and its ForeignKey fields that point to
+        the model and to the related model.
+        """
+        return (self.field_obj.rel.through,
+                self.field_info['fkey_this'],
+                self.field_info['fkey_other'])
+
+    def apply_filter(self, qs):
+        # Filtering by each chosen object in turn would add a join to the
+        # intermediate table for each one. Instead, the items that are related
+        # to all (or any) of them are found using a single subquery on the
+        # intermediate table, so that qs has no joins that multiply rows.
+        if not self.chosen:
+            return qs
+        if self.rel_model == self.model:
+            if self.match == 'any':
+                matching = self.model._default_manager.filter(
+                    **{self.field + '__in': list(self.chosen)})
+                return qs.filter(pk__in=matching.values('pk'))
+            return super(ManyToManyFilter, self).apply_filter(qs)
+        through, fkey_this, fkey_other = self.get_through_fields()
+        chosen_values = set(getattr(c, self.rel_field.attname) for c in self.chosen)
+        matching = through.objects.filter(**{fkey_other.name + '__in': list(chosen_values)})
+        if self.match == 'all' and len(chosen_values) > 1:
+            matching = (matching
+                        .values(fkey_this.name)
+                        .annotate(easyfilter_count=models.Count(fkey_other.name, distinct=True))
+                        .filter(easyfilter_count=len(chosen_values)))
+        return qs.filter(pk__in=matching.values(fkey_this.name))
+
     def get_values_counts(self, qs):
+        count_dict = self.get_prefetched(qs, 'counts')
+        if count_dict is None:
+            count_dict = self.query_values_counts(qs)
+        return self.limit_counts(count_dict)
+
+    def prefetch_counts(self, qs, batch):
+        if self.can_batch_counts():
+            m2m_objs, field_name = self.get_counts_qs(qs)
+            self.set_prefetched(qs, counts=batch.value_counts(m2m_objs, field_name))
+
+    def prefetch_disjunctive_counts(self, qs, batch, base_qs, conditions):
+        if self.can_batch_counts():
+            m2m_objs, field_name = self.get_counts_qs(base_qs)
+            through, fkey_this, fkey_other = self.get_through_fields()
+            self.set_prefetched(qs, counts=batch.value_counts(m2m_objs, field_name,
+                                                              fkey_this.name, conditions))
+
+    def get_counts_qs(self, qs):
+        """
+        Returns a QuerySet of the intermediate table, limited to the items in
+        qs, and the name of the field on it that points to the related model.
+        """
         # It is easiest to base queries around the intermediate table, in order
         # to get counts.
-        through = self.field_obj.rel.through
-        rel_model = self.rel_model
-
-        assert rel_model != self.model, "Can't cope with this yet..."
-        fkey_this = [f for f in through._meta.fields
-                     if f.rel is not None and f.rel.to is self.model][0]
-        fkey_other = [f for f in through._meta.fields
-                      if f.rel is not None and f.rel.to is rel_model][0]
+        assert self.rel_model != self.model, "Can't cope with this yet..."
+        through, fkey_this, fkey_other = self.get_through_fields()
 
         # We need to limit items by what is in the main QuerySet (which might
         # already be filtered).
@@ -396,20 +1307,29 @@ class ManyToManyFilter(ChooseAgainMixin, RelatedObjectMixin, Filter):
         # on, because they are not interesting.
         m2m_objs = m2m_objs.exclude(**{fkey_other.name + '__in': self.chosen})
 
-        # Now get counts:
-        field_name = fkey_other.name
-        return value_counts(m2m_objs, field_name)
+        return m2m_objs, fkey_other.name
 
-    def get_choices_add(self, qs):
-        count_dict = self.get_values_counts(qs)
-        # Now, need to lookup objects on related table, to display them.
-        objs = self.rel_model.objects.filter(pk__in=count_dict.keys())
+    def get_sampled_counts_qs(self, qs):
+        modulus = self.get_sample_modulus(qs)
+        self.counts_estimated = modulus is not None
+        m2m_objs, field_name = self.get_counts_qs(qs)
+        if modulus is None:
+            return m2m_objs, field_name, 1
+        # qs is used in a subquery, whose tables Django renames, so the sample
+        # is taken from the intermediate table's key for it instead.
+        through, fkey_this, fkey_other = self.get_through_fields()
+        return sample_queryset(m2m_objs, modulus, fkey_this.name), field_name, modulus
 
-        return [FilterChoice(self.render_choice_object(o),
-                             count_dict[o.pk],
-                             self.build_params(add=o),
-                             FILTER_ADD)
-                for o in objs]
+    def has_choices(self, qs):
+        # Only related objects that exist are chosen.
+        return len(self.chosen) > 0 or self.get_counts_qs(qs)[0].exists()
+
+    def choice_from_value(self, value):
+        # Choices are model instances, but only the PK is needed.
+        return self.rel_model(**{self.rel_field.attname: value})
+
+    def get_choices_add(self, qs):
+        return self.get_related_choices_add(qs)
 
     def param_from_choice(self, choice):
         return six.text_type(choice.pk)
@@ -608,11 +1528,15 @@ class DateTimeFilter(RangeFilterMixin, Filter):
         self.max_depth = kwargs.pop('max_depth', None)
         assert self.max_depth in ['year', 'month', None]
         self.max_depth_level = self.max_depth_levels[self.max_depth]
+        self.single_query = kwargs.pop('single_query', False)
         super(DateTimeFilter, self).__init__(*args, **kwargs)
 
     def render_choice_object(self, choice):
         return choice.display()
 
+    def has_choices(self, qs):
+        return len(self.chosen) > 0 or qs.filter(**{self.field + '__isnull': False}).exists()
+
     def get_choices_remove(self, qs):
         chosen = list(self.chosen)
         out = []
@@ -623,13 +1547,19 @@ class DateTimeFilter(RangeFilterMixin, Filter):
             to_remove = [c for c in chosen if c >= choice]
             out.append(FilterChoice(self.render_choice_object(choice),
                                     None,
-                                    self.build_params(remove=to_remove),
+                                    self.build_link(remove=to_remove),
                                     FILTER_REMOVE))
             # There can be cases where there are gaps, so we need to bridge
             # using FILTER_DISPLAY
             out.extend(self.bridge_choices(chosen[0:i + 1], chosen[i + 1:]))
         return out
 
+    def prefetch_counts(self, qs, batch):
+        if len(self.chosen) == 0 and not self.single_query:
+            # Only the first query, for the range of dates, can be known in
+            # advance.
+            self.set_prefetched(qs, stats=batch.value_stats(qs, self.field))
+
     def get_choices_add(self, qs):
         chosen = list(self.chosen)
 
@@ -647,10 +1577,16 @@ class DateTimeFilter(RangeFilterMixin, Filter):
 
             if range_type is None:
                 # Get some initial idea of range
-                date_range = qs.aggregate(first=models.Min(self.field),
-                                          last=models.Max(self.field))
-                first = date_range['first']
-                last = date_range['last']
+                date_range = self.get_prefetched(qs, 'stats')
+                if self.single_query:
+                    results = self.get_date_counts(qs, self.histogram_range_type())
+                    date_range = {'lower': results[0][0] if results else None,
+                                  'upper': results[-1][0] if results else None}
+                elif date_range is None:
+                    date_range = qs.aggregate(lower=models.Min(self.field),
+                                              upper=models.Max(self.field))
+                first = date_range['lower']
+                last = date_range['upper']
                 if first is None or last is None:
                     # No values, can't drill down:
                     return []
@@ -662,18 +1598,7 @@ class DateTimeFilter(RangeFilterMixin, Filter):
                 else:
                     range_type = YEAR
 
-            # API for `QuerySet.dates` used to return a list of `datetime` objects,
-            # but from Django 1.6 onwards, it returns a list of `date` objects instead.
-            # See: https://docs.djangoproject.com/en/1.6/releases/1.6/#queryset-dates-returns-date-objects
-            # for django under 1.6 id doesnt matter if field is DateField or DateTime field
-            # we need check it for django 1.6
-            if isinstance(self.field_obj, DateTimeField):
-                date_qs = (qs.datetimes(self.field, range_type.label) if hasattr(qs, 'datetimes') else
-                           qs.dates(self.field, range_type.label))
-            else:
-                date_qs = qs.dates(self.field, range_type.label)
-            results = date_aggregation(date_qs)
-
+            results = self.get_date_counts(qs, range_type)
             date_choice_counts = self.collapse_results(results, range_type)
             if len(date_choice_counts) == 1 and range_type is not None:
                 # Single choice - recurse.
@@ -715,10 +1640,51 @@ class DateTimeFilter(RangeFilterMixin, Filter):
 
             choices.append(FilterChoice(self.render_choice_object(date_choice),
                                         count,
-                                        self.build_params(add=date_choice),
+                                        self.build_link(add=date_choice),
                                         link_type))
         return choices
 
+    def histogram_range_type(self):
+        # The finest level that can affect the choices. Drill-down can go one
+        # level past max_depth, but no further.
+        if self.max_depth_level < MONTH.level:
+            return MONTH
+        return DAY
+
+    def get_date_counts(self, qs, range_type):
+        """
+        Returns a list of (datetime, count) for the values of the field in qs,
+        truncated to range_type, in order.
+        """
+        if not self.single_query:
+            return list(date_histogram(qs, self.field, range_type.label))
+
+        # All levels are derived from a single query at the finest level needed.
+        histogram = getattr(self, '_date_histogram', None)
+        if histogram is None or histogram[0] is not qs:
+            histogram_range_type = self.histogram_range_type()
+            histogram = (qs, histogram_range_type,
+                         list(date_histogram(qs, self.field, histogram_range_type.label)))
+            self._date_histogram = histogram
+        qs, histogram_range_type, rows = histogram
+        if range_type.level >= histogram_range_type.level:
+            # Going deeper than the histogram only happens beyond max_depth,
+            # where the values are used just for bridging, and for the
+            # existence of choices.
+            return rows
+
+        results = []
+        for dt, count in rows:
+            if range_type is YEAR:
+                dt = dt.replace(month=1, day=1)
+            else:
+                dt = dt.replace(day=1)
+            if results and results[-1][0] == dt:
+                results[-1] = (dt, results[-1][1] + count)
+            else:
+                results.append((dt, count))
+        return results
+
     def collapse_results(self, results, range_type):
         if len(results) > self.max_links:
             # If range_type is month/day, we don't want any possibility of the
@@ -887,10 +1853,19 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
         self.max_links = kwargs.pop('max_links', 5)
         self.drilldown = kwargs.pop('drilldown', True)
         self.ranges = kwargs.pop('ranges', None)
-        field_obj = model._meta.get_field(field)
-        self.choice_type = make_numeric_range_choice(field_obj.to_python, str)
+        self.choice_type = self.get_field_info(model, field)['choice_type']
         super(NumericRangeFilter, self).__init__(field, model, params, **kwargs)
 
+    @classmethod
+    def make_field_info(cls, model, field):
+        info = super(NumericRangeFilter, cls).make_field_info(model, field)
+        info['choice_type'] = make_numeric_range_choice(info['field_obj'].to_python, str)
+        return info
+
+    def has_choices(self, qs):
+        # Every value, including NULL, is counted somewhere.
+        return len(self.chosen) > 0 or qs.exists()
+
     def render_choice_object(self, c):
         if self.ranges is None:
             return c.display()
@@ -906,30 +1881,68 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
                     return c.display()
         return c.display()
 
+    def prefetch_counts(self, qs, batch):
+        if self.has_few_values():
+            self.set_prefetched(qs, counts=batch.value_counts(qs, self.field))
+        elif self.drilldown or len(self.chosen) == 0:
+            self.set_prefetched(qs, stats=batch.value_stats(qs, self.field))
+
+    def has_few_values(self):
+        """
+        Returns True if field_stats show that there are few enough values in
+        the whole table for each one to be a choice, so the values of the
+        QuerySet don't need to be checked first.
+        """
+        if self.field_stats is None or self.ranges is not None:
+            return False
+        num = self.field_stats['distinct'] + (1 if self.field_stats['null_fraction'] else 0)
+        return num <= self.max_links
+
     def get_choices_add(self, qs):
         chosen = list(self.chosen)
 
         if not self.drilldown and len(chosen) > 0:
             return []
 
-        all_vals = qs.values_list(self.field).distinct()
-
-        num = all_vals.count()
+        if self.has_few_values():
+            val_counts = self.get_prefetched(qs, 'counts')
+            if val_counts is None:
+                val_counts = value_counts(qs, self.field)
+            if len(val_counts) > self.max_links:
+                # The statistics are out of date. The values found give the
+                # range of values, to use ranges instead.
+                values = [v for v in val_counts if v is not None]
+                stats = {'lower': min(values), 'upper': max(values)}
+                val_counts = None
+        else:
+            # The statistics tell us which kind of choices to produce, and are
+            # enough on their own for the simplest cases.
+            stats = self.get_prefetched(qs, 'stats')
+            if stats is None:
+                stats = value_stats(qs, self.field)
+            # NULL counts as a distinct value.
+            has_null = stats['rows'] > stats['count']
+            num = stats['distinct'] + (1 if has_null else 0)
+            if num > self.max_links:
+                val_counts = None
+            elif num <= 1 and not has_null:
+                val_counts = {}
+                if num == 1:
+                    val_counts[stats['lower']] = stats['count']
+            else:
+                val_counts = value_counts(qs, self.field)
 
         choices = []
-        if num <= self.max_links:
-            val_counts = value_counts(qs, self.field)
+        if val_counts is not None:
             for v, count in val_counts.items():
                 choice = self.choice_type([RangeEnd(v, True)])
                 choices.append(FilterChoice(self.render_choice_object(choice),
                                             count,
-                                            self.build_params(add=choice),
+                                            self.build_link(add=choice),
                                             FILTER_ADD))
         else:
             if self.ranges is None:
-                val_range = qs.aggregate(lower=models.Min(self.field),
-                                         upper=models.Max(self.field))
-                ranges = auto_ranges(val_range['lower'], val_range['upper'], self.max_links)
+                ranges = auto_ranges(stats['lower'], stats['upper'], self.max_links)
             else:
                 ranges = self.ranges
 
@@ -943,7 +1956,7 @@ class NumericRangeFilter(RangeFilterMixin, SingleValueMixin, Filter):
                                            RangeEnd(vals[1], True)])
                 choices.append(FilterChoice(self.render_choice_object(choice),
                                             count,
-                                            self.build_params(add=choice),
+                                            self.build_link(add=choice),
                                             FILTER_ADD))
 
         return choices
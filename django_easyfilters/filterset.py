@@ -1,17 +1,38 @@
+from contextlib import contextmanager
+import json
+import threading
+import time
+
 import six
 
 from django import template
 from django.template.loader import get_template
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import translation
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 
+from . import cache, stats
 from .filters import (FILTER_DISPLAY, FILTER_REMOVE,
-                      ChoicesFilter, DateTimeFilter,
+                      Filter, ChoicesFilter, DateTimeFilter,
                       ForeignKeyFilter, ManyToManyFilter,
-                      NumericRangeFilter, ValuesFilter)
+                      NumericRangeFilter, RangeFilterMixin, ValuesFilter)
+from .queries import FacetBatch, can_sample, count_at_most, materialized_ids
 from .utils import python_2_unicode_compatible
 
+try:
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+except ImportError:
+    # Python 2 without the 'futures' backport. Executors should raise this
+    # from Future.result() when the timeout is reached.
+    class FutureTimeoutError(Exception):
+        pass
+
+INTEGER_FIELD_TYPES = ('IntegerField', 'BigIntegerField', 'SmallIntegerField',
+                       'PositiveIntegerField', 'PositiveSmallIntegerField')
+
 
 def non_breaking_spaces(val):
     # This helps a lot with presentation, by stopping the links+count from being
@@ -20,6 +41,14 @@ def non_breaking_spaces(val):
     return mark_safe(u'&nbsp;'.join(escape(part) for part in val.split(u' ')))
 
 
+@contextmanager
+def unmaterialized(qs):
+    """
+    The counterpart of queries.materialized_ids, that returns qs as it is.
+    """
+    yield qs
+
+
 class cachedproperty(object):
     """
     Decorator that creates converts a method with a single
@@ -43,10 +72,74 @@ class FilterSet(object):
 
     title_fields = None
 
-    def __init__(self, queryset, params):
+    # If set, an object with a render(filterlabel, choices) method, such as
+    # renderers.FastRenderer(), which is used instead of templates.
+    renderer = None
+
+    # If True, the count queries of all the filters are combined into a single
+    # database query, where possible.
+    batch_counts = False
+
+    # If set to an integer N, it is used as the default 'approximate' option
+    # for the filters, so that counts are estimated from a sample of about 1 in
+    # N rows when there are a lot of rows.
+    approximate_counts = None
+
+    # If set, when the choices for at least this number of filters are computed
+    # together, the primary keys of the filtered QuerySet are first stored in a
+    # temporary table, and the count queries for the filters use that instead
+    # of repeating the filtering.
+    materialize_min_filters = None
+
+    # If True, statistics about each field from the catalogue in
+    # django_easyfilters.stats, which are refreshed in the background after
+    # field_stats_ttl seconds, are used to choose filter classes and options:
+    # - integer fields with more than field_stats_max_values distinct values
+    #   use NumericRangeFilter rather than ValuesFilter.
+    # - other filters for such fields show only the field_stats_max_values
+    #   values with the largest counts.
+    # - for tables with more than field_stats_sample_rows rows, counts are
+    #   estimated from a sample of about that many rows.
+    use_field_stats = False
+    field_stats_ttl = 24 * 60 * 60
+    field_stats_max_values = 30
+    field_stats_sample_rows = 1000000
+
+    # If cache_timeout is not None, the choices for each filter are cached for
+    # that number of seconds, in the cache named by cache_alias.
+    cache_timeout = None
+    cache_alias = 'default'
+
+    # If cache_stale_timeout is set, cached choices will continue to be used for
+    # that number of seconds after they expire, while they are recomputed in
+    # the background.
+    cache_stale_timeout = None
+
+    # If True, the counts for each filter are calculated from the QuerySet with
+    # all the other filters applied, but not its own, for filters that allow
+    # this.
+    disjunctive_counts = False
+
+    # If executor is set to an object compatible with
+    # concurrent.futures.Executor, the choices for the filters are computed
+    # concurrently using it.
+    executor = None
+
+    # Time limit in seconds for computing choices using the executor. Filters
+    # that have not finished in time are displayed without any choices.
+    choices_deadline = None
+
+    def __init__(self, queryset, params, executor=None):
+        if executor is not None:
+            self.executor = executor
         self.params = params
         self.model = queryset.model
+        self.timed_out_fields = []
+        # See count_rows_at_most(). The filters may be run concurrently.
+        self._row_counts = {}
+        self._row_counts_lock = threading.Lock()
         self.filters = self.setup_filters()
+        self.initial_qs = queryset
         self.qs = self.apply_filters(queryset)
 
     @cachedproperty
@@ -54,39 +147,453 @@ class FilterSet(object):
         return self.make_title()
 
     def __nonzero__(self):
-        return any(self.get_filter_choices(f.field) for f in self.filters)
+        for f in self.filters:
+            if self.computes_all_choices() or f.field in self._cached_filter_choices:
+                if self.get_filter_choices(f.field):
+                    return True
+            elif self.filter_has_choices(f):
+                return True
+        return False
+
+    __bool__ = __nonzero__
+
+    def computes_all_choices(self):
+        # If choices are batched, computed concurrently or cached, or filters
+        # have disjunctive counts, it is cheaper to get them for all filters
+        # together. Otherwise each filter's choices are only computed when they
+        # are needed.
+        return (self.batch_counts or self.executor is not None or
+                self.cache_timeout is not None or
+                self.materialize_min_filters is not None or
+                len(self.get_disjunctive_filters()) > 1)
+
+    def filter_has_choices(self, filter_):
+        """
+        Returns True if the filter has any choices, without computing them if
+        the filter supports this.
+        """
+        if hasattr(filter_, 'has_choices'):
+            return filter_.has_choices(self.get_filter_queryset(filter_))
+        return len(self.get_filter_choices(filter_.field)) > 0
+
+    @cachedproperty
+    def _cached_filter_choices(self):
+        return {}
 
     def get_filter_choices(self, filter_field):
-        if not hasattr(self, '_cached_filter_choices'):
-            self._cached_filter_choices = dict((f.field, f.get_choices(self.qs))
-                                               for f in self.filters)
-        return self._cached_filter_choices[filter_field]
+        choices = self._cached_filter_choices
+        if filter_field not in choices:
+            if self.computes_all_choices():
+                filters = [f for f in self.filters if f.field not in choices]
+            else:
+                filters = [f for f in self.filters if f.field == filter_field]
+            choices.update(self.compute_filter_choices(filters))
+        return choices[filter_field]
+
+    def compute_filter_choices(self, filters):
+        """
+        Returns a dictionary of {field: choices} for the filters.
+        """
+        if self.cache_timeout is None:
+            choices = {}
+        else:
+            choices = self.get_cached_choices(filters)
+        missing = [f for f in filters if f.field not in choices]
+        if self.executor is None:
+            with self.get_counts_queryset(missing) as qs:
+                if self.batch_counts:
+                    self.prefetch_counts(missing, qs)
+                else:
+                    self.prefetch_counts(self.get_disjunctive_filters(missing), qs)
+                for f in missing:
+                    choices[f.field] = f.get_choices(self.get_filter_queryset(f, qs))
+        else:
+            if self.batch_counts:
+                self.prefetch_counts(missing)
+            else:
+                self.prefetch_counts(self.get_disjunctive_filters(missing))
+            choices.update(self.compute_choices_concurrently(missing))
+        if self.cache_timeout is not None:
+            self.set_cached_choices([f for f in missing
+                                     if f.field not in self.timed_out_fields],
+                                    choices)
+        return choices
+
+    def get_filter_queryset(self, filter_, qs=None):
+        """
+        Returns the QuerySet to pass to the filter when computing its choices.
+        This is self.qs, or 'qs' if given, unless disjunctive_counts applies to
+        the filter.
+        """
+        if qs is None:
+            qs = self.qs
+        if not self.get_disjunctive_filters([filter_]):
+            return qs
+        # The same QuerySet must be returned every time, for prefetch_counts.
+        querysets = self._disjunctive_querysets
+        if filter_.field not in querysets:
+            filtered = self.initial_qs
+            for f in self.filters:
+                if f is not filter_:
+                    filtered = f.apply_filter(filtered)
+            querysets[filter_.field] = filtered
+        return querysets[filter_.field]
+
+    @cachedproperty
+    def _disjunctive_querysets(self):
+        return {}
+
+    def get_disjunctive_filters(self, filters=None):
+        """
+        Returns those of 'filters', or of all the filters, whose counts are
+        calculated without their own choices applied (see disjunctive_counts).
+        """
+        if not self.disjunctive_counts:
+            return []
+        if filters is None:
+            filters = self.filters
+        return [f for f in filters
+                if getattr(f, 'allows_disjunctive_counts', False) and f.chosen]
+
+    @cachedproperty
+    def _disjunctive_base_queryset(self):
+        # The QuerySet with all the filters applied except those from
+        # get_disjunctive_filters(), which the counts of those filters are
+        # found from using conditional aggregation.
+        disjunctive = self.get_disjunctive_filters()
+        qs = self.initial_qs
+        for f in self.filters:
+            if not any(f is d for d in disjunctive):
+                qs = f.apply_filter(qs)
+        return qs
+
+    def count_rows_at_most(self, qs, limit):
+        """
+        Returns count_at_most(qs, limit), which filters use to decide whether
+        to estimate counts (see approximate_counts). The result is kept for
+        each QuerySet, so that the filters sharing it only run one query.
+        """
+        counts = self._row_counts
+        key = (id(qs), limit)
+        with self._row_counts_lock:
+            if key not in counts:
+                # The QuerySet is kept, so that its id isn't reused.
+                counts[key] = (qs, count_at_most(qs, limit))
+            return counts[key][1]
+
+    def get_counts_queryset(self, filters):
+        """
+        Returns a context manager for the QuerySet to pass to the filters when
+        computing their choices, which uses materialized_ids() if there are
+        enough filters (see materialize_min_filters).
+        """
+        # Temporary tables are only visible to one connection, so this can't
+        # be used with the executor.
+        if (self.materialize_min_filters is not None and
+                len(filters) >= self.materialize_min_filters):
+            # The QuerySet is used several times in the same statement by
+            # batch_counts, and for count_cap.
+            reopen = self.batch_counts or any(getattr(f, 'count_cap', None) is not None
+                                              for f in filters)
+            return materialized_ids(self.qs, reopen=reopen)
+        return unmaterialized(self.qs)
+
+    def compute_choices_concurrently(self, filters):
+        using = self.qs.db
+        owner = threading.current_thread()
+
+        def get_choices(f):
+            try:
+                return f.get_choices(self.get_filter_queryset(f))
+            finally:
+                # Worker threads each get their own connection, which must not
+                # be left open.
+                if threading.current_thread() is not owner:
+                    connections[using].close()
+
+        futures = [(f, self.executor.submit(get_choices, f)) for f in filters]
+        if self.choices_deadline is not None:
+            deadline = time.time() + self.choices_deadline
+        choices = {}
+        for f, future in futures:
+            if self.choices_deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - time.time())
+            try:
+                choices[f.field] = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                self.timed_out_fields.append(f.field)
+                choices[f.field] = []
+        return choices
+
+    def prefetch_counts(self, filters, qs=None):
+        if qs is None:
+            qs = self.qs
+        batch = FacetBatch(qs.db)
+        disjunctive = self.get_disjunctive_filters()
+        for f in filters:
+            # Custom filters are not required to support this.
+            if not hasattr(f, 'prefetch_counts'):
+                continue
+            if any(f is d for d in disjunctive):
+                # Rather than a differently filtered QuerySet for each of
+                # these filters, the same rows are used for all of them, and
+                # the choices of the others are applied as conditions.
+                if hasattr(f, 'prefetch_disjunctive_counts'):
+                    conditions = [d.apply_filter(self.model._base_manager.all())
+                                  for d in disjunctive if d is not f]
+                    f.prefetch_disjunctive_counts(self.get_filter_queryset(f, qs), batch,
+                                                  self._disjunctive_base_queryset,
+                                                  conditions)
+            else:
+                f.prefetch_counts(self.get_filter_queryset(f, qs), batch)
+        batch.execute()
+
+    def get_cache(self):
+        return cache.get_cache(self.cache_alias)
+
+    def get_cacheable_filters(self, filters):
+        # Custom filters that don't inherit from Filter may not have the methods
+        # needed to rebuild choices from the cache.
+        return [f for f in filters if isinstance(f, Filter)]
+
+    def get_cache_models(self, filters):
+        """
+        Returns the models whose changes should invalidate cached choices.
+        """
+        models = [self.model]
+        for f in filters:
+            rel_model = getattr(f, 'rel_model', None)
+            if rel_model is not None:
+                models.append(rel_model)
+                through = getattr(f.field_obj.rel, 'through', None)
+                if through is not None:
+                    models.append(through)
+        return models
+
+    def get_cache_keys(self, filters):
+        """
+        Returns a dictionary of {field: cache key} for the filters.
+        """
+        query_keys = {}
+        for f in filters:
+            qs = self.get_filter_queryset(f)
+            if id(qs) not in query_keys:
+                try:
+                    query_keys[id(qs)] = cache.query_key(qs)
+                except EmptyResultSet:
+                    query_keys[id(qs)] = None
+        models = self.get_cache_models(filters)
+        cache.watch_models(self.cache_alias, models)
+        versions = cache.get_versions(self.get_cache(), models)
+        language = translation.get_language()
+        return dict((f.field, cache.make_key(query_keys[id(self.get_filter_queryset(f))],
+                                             f.__class__.__module__,
+                                             f.__class__.__name__,
+                                             f.field,
+                                             f.query_param,
+                                             cache.option_key(self.filter_options[f.field]),
+                                             f.paramlist_from_choices(f.chosen),
+                                             language,
+                                             versions))
+                    for f in filters)
+
+    def get_cached_choices(self, filters):
+        """
+        Returns a dictionary of {field: choices} for the filters that have
+        choices in the cache.
+        """
+        filters = self.get_cacheable_filters(filters)
+        keys = self.get_cache_keys(filters)
+        entries = self.get_cache().get_many(list(keys.values()))
+        now = time.time()
+        choices = {}
+        stale = []
+        for f in filters:
+            entry = entries.get(keys[f.field])
+            if entry is None:
+                continue
+            choices[f.field] = cache.load_choices(f, entry['choices'])
+            f.more_choices = entry.get('more', False)
+            if self.cache_stale_timeout is not None and entry['expires'] <= now:
+                # Make sure only one process does the update
+                if self.get_cache().add(keys[f.field] + ':revalidate', True,
+                                        self.cache_stale_timeout):
+                    stale.append(f)
+        if stale:
+            self.revalidate_choices(stale)
+        return choices
+
+    def set_cached_choices(self, filters, choices):
+        filters = self.get_cacheable_filters(filters)
+        if not filters:
+            return
+        keys = self.get_cache_keys(filters)
+        expires = time.time() + self.cache_timeout
+        self.get_cache().set_many(
+            dict((keys[f.field], {'expires': expires,
+                                  'choices': cache.dump_choices(f, choices[f.field]),
+                                  'more': f.more_choices})
+                 for f in filters),
+            self.cache_timeout + (self.cache_stale_timeout or 0))
+
+    def refresh_cached_choices(self, filters):
+        self.set_cached_choices(filters,
+                                dict((f.field, f.get_choices(self.get_filter_queryset(f)))
+                                     for f in filters))
+
+    def revalidate_choices(self, filters):
+        """
+        Called with a list of filters whose cached choices have expired but are
+        still being used, to recompute them. By default this is done in a
+        background thread.
+        """
+        cache.run_in_thread(self.qs.db, self.refresh_cached_choices, filters)
 
     def apply_filters(self, queryset):
         for f in self.filters:
             queryset = f.apply_filter(queryset)
         return queryset
 
-    def render_filter(self, filter_):
-        field_obj = self.model._meta.get_field(filter_.field)
+    def get_filter_label(self, filter_):
+        field_obj = getattr(filter_, 'field_obj', None)
+        if field_obj is None:
+            field_obj = self.model._meta.get_field(filter_.field)
+        return capfirst(field_obj.verbose_name)
+
+    def render_filter(self, filter_, context=None):
         choices = self.get_filter_choices(filter_.field)
-        ctx = {'filterlabel': capfirst(field_obj.verbose_name)}
+        if self.renderer is not None:
+            return self.renderer.render(self.get_filter_label(filter_), choices)
+        ctx = {'filterlabel': self.get_filter_label(filter_)}
         ctx['choices'] = [dict(label=non_breaking_spaces(c.label),
-                               url=u'?' + c.params.urlencode()
+                               url=u'?' + c.query
                                    if c.link_type != FILTER_DISPLAY else None,
                                link_type=c.link_type,
-                               count=c.count)
+                               count=c.count,
+                               is_estimate=c.is_estimate,
+                               is_capped=c.is_capped)
                           for c in choices]
-        return self.get_template(filter_.field).render(template.Context(ctx))
+        ctx['more_choices'] = self.has_more_choices(filter_)
+        if context is None:
+            context = template.Context()
+        # Context.update pushes a new dict, so the context can be reused for the
+        # next filter.
+        context.update(ctx)
+        try:
+            return self.get_template(filter_.field).render(context)
+        finally:
+            context.pop()
+
+    def has_more_choices(self, filter_):
+        """
+        Returns True if some choices of the filter were not returned because of
+        its 'max_choices' option.
+        """
+        self.get_filter_choices(filter_.field)
+        return getattr(filter_, 'more_choices', False)
 
     def get_template(self, field_name):
+        # Compiled templates are cached on the class.
+        templates = self.__class__.__dict__.get('_templates')
+        if templates is None:
+            templates = {}
+            self.__class__._templates = templates
+        key = (field_name, self.template, self.template_file)
+        try:
+            return templates[key]
+        except KeyError:
+            t = templates[key] = self.load_template(field_name)
+            return t
+
+    def load_template(self, field_name):
         if self.template:
             return template.Template(self.template)
         else:
             return get_template(self.template_file)
 
     def render(self):
-        return mark_safe(u'\n'.join(self.render_filter(f) for f in self.filters))
+        context = template.Context()
+        return mark_safe(u'\n'.join(self.render_filter(f, context) for f in self.filters))
+
+    def as_data(self, fingerprint=None):
+        """
+        Returns the choices for all the filters as a dictionary that can be
+        serialised as JSON.
+
+        If 'fingerprint' is the 'fingerprint' value from previous output,
+        filters whose output has not changed since then are returned without
+        their choices, and with 'unchanged' set to True.
+        """
+        known = set(fingerprint.split('.')) if fingerprint else set()
+        filters = []
+        for f in self.filters:
+            data = self.filter_data(f)
+            data['fingerprint'] = cache.make_fingerprint(data)
+            if data['fingerprint'] in known:
+                data = {'field': data['field'],
+                        'fingerprint': data['fingerprint'],
+                        'unchanged': True}
+            filters.append(data)
+        return {'fingerprint': '.'.join(data['fingerprint'] for data in filters),
+                'filters': filters}
+
+    def filter_data(self, filter_):
+        """
+        Returns a dictionary describing the filter and its choices.
+        """
+        choices = self.get_filter_choices(filter_.field)
+        return {'field': filter_.field,
+                'label': six.text_type(self.get_filter_label(filter_)),
+                'choices': [self.choice_data(c) for c in choices],
+                'more': self.has_more_choices(filter_)}
+
+    def choice_data(self, choice):
+        return {'label': six.text_type(choice.label),
+                'count': choice.count,
+                'link_type': choice.link_type,
+                'is_estimate': choice.is_estimate,
+                'is_capped': choice.is_capped,
+                'query': (choice.query
+                          if choice.link_type != FILTER_DISPLAY else None)}
+
+    def get_filter(self, field):
+        """
+        Returns the filter for the field name 'field', raising KeyError if
+        there isn't one.
+        """
+        for f in self.filters:
+            if f.field == field:
+                return f
+        raise KeyError(field)
+
+    def choices_page_data(self, field, limit, offset=0, prefix=None, after=None):
+        """
+        Returns a page of the 'add' choices for the filter for 'field' as a
+        dictionary that can be serialised as JSON. See
+        Filter.get_choices_page() for the arguments.
+        """
+        filter_ = self.get_filter(field)
+        choices, more = filter_.get_choices_page(self.get_filter_queryset(filter_),
+                                                 limit, offset=offset,
+                                                 prefix=prefix, after=after)
+        data = []
+        for c in choices:
+            item = self.choice_data(c)
+            item['value'] = filter_.choice_value_param(c)
+            data.append(item)
+        return {'field': field,
+                'choices': data,
+                'more': more,
+                'after': data[-1]['value'] if data else None}
+
+    def to_json(self, fingerprint=None):
+        """
+        Returns the output of as_data() as a JSON string.
+        """
+        return json.dumps(self.as_data(fingerprint=fingerprint))
 
     def get_fields(self):
         return self.fields
@@ -109,9 +616,110 @@ class FilterSet(object):
             else:
                 return ValuesFilter
 
+    def get_class_from_stats(self, field_name, klass, field_stats):
+        """
+        Returns the filter class to use for a field instead of 'klass', the one
+        chosen by get_filter_for_field(), given the statistics for the field.
+        This is done for each FilterSet, so that it follows the statistics.
+        """
+        if (klass is ValuesFilter and
+                self.model._meta.get_field(field_name).get_internal_type() in INTEGER_FIELD_TYPES and
+                field_stats['distinct'] > self.field_stats_max_values):
+            return NumericRangeFilter
+        return klass
+
     def setup_filters(self):
         filters = []
-        for i, f in enumerate(self.get_fields()):
+        self.filter_options = {}
+        if self.use_field_stats:
+            explicit_classes = set(f[0] for f in self.get_fields()
+                                   if not isinstance(f, six.string_types) and len(f) > 2)
+        for field_name, klass, opts in self.get_filter_specs():
+            field_stats = None
+            if self.use_field_stats and issubclass(klass, Filter):
+                field_stats = self.get_field_stats(field_name)
+                if field_name not in explicit_classes:
+                    klass = self.get_class_from_stats(field_name, klass, field_stats)
+            if (self.approximate_counts is not None and issubclass(klass, Filter) and
+                    'approximate' not in opts):
+                opts = dict(opts, approximate=self.approximate_counts)
+            if field_stats is not None:
+                opts = self.get_options_from_stats(klass, opts, field_stats)
+            self.filter_options[field_name] = opts
+            filter_ = klass(field_name, self.model, self.params, **opts)
+            if field_stats is not None:
+                filter_.field_stats = field_stats
+            if issubclass(klass, Filter):
+                filter_.count_rows_at_most = self.count_rows_at_most
+            filters.append(filter_)
+        return filters
+
+    def get_field_stats(self, field_name):
+        """
+        Returns the statistics for a field from the catalogue, see
+        use_field_stats.
+        """
+        return stats.get_field_stats(self.model, field_name, self.field_stats_ttl,
+                                     refresh=self.refresh_field_stats)
+
+    def refresh_field_stats(self, model, field_name):
+        """
+        Called when the statistics for a field are older than field_stats_ttl,
+        to update them. By default this is done in a background thread.
+        """
+        stats.refresh_in_background(model, field_name)
+
+    def get_options_from_stats(self, klass, opts, field_stats):
+        """
+        Returns the options for a filter, adding defaults that depend on the
+        statistics for the field. Options that are specified are not changed.
+        """
+        opts = dict(opts)
+        if (not issubclass(klass, RangeFilterMixin) and
+                field_stats['distinct'] > self.field_stats_max_values and
+                'max_choices' not in opts):
+            opts['max_choices'] = self.field_stats_max_values
+            opts.setdefault('order_by_count', True)
+        if (field_stats['rows'] > self.field_stats_sample_rows and
+                can_sample(self.model) and 'approximate' not in opts):
+            opts['approximate'] = field_stats['rows'] // self.field_stats_sample_rows + 1
+        return opts
+
+    @classmethod
+    def compile(cls, model):
+        """
+        Works out the filter classes and options for the model, and the
+        information about each field that the filters need. This is done once
+        for each FilterSet class and model, on first use, but can be called
+        in advance e.g. from AppConfig.ready()
+        """
+        compiled = cls.__dict__.get('_compiled_specs')
+        if compiled is None:
+            compiled = {}
+            # Set on this class, so that subclasses don't share it.
+            cls._compiled_specs = compiled
+        if model not in compiled:
+            # The methods that produce the specs only need 'model', not the
+            # request.
+            instance = cls.__new__(cls)
+            instance.model = model
+            compiled[model] = instance.make_filter_specs()
+        return compiled[model]
+
+    def get_filter_specs(self):
+        """
+        Returns a list of (field name, filter class, options) for the filters.
+        """
+        if (six.get_unbound_function(self.__class__.get_fields) is not
+                six.get_unbound_function(FilterSet.get_fields)):
+            # get_fields() might depend on the request, so can't be compiled
+            # once per class.
+            return self.make_filter_specs()
+        return self.compile(self.model)
+
+    def make_filter_specs(self):
+        specs = []
+        for f in self.get_fields():
             klass = None
             if isinstance(f, six.string_types):
                 opts = {}
@@ -123,8 +731,10 @@ class FilterSet(object):
                     klass = f[2]
             if klass is None:
                 klass = self.get_filter_for_field(field_name)
-            filters.append(klass(field_name, self.model, self.params, **opts))
-        return filters
+            if hasattr(klass, 'get_field_info'):
+                klass.get_field_info(self.model, field_name)
+            specs.append((field_name, klass, opts))
+        return specs
 
     def make_title(self):
         if self.title_fields is None:
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_easyfilters.models import FieldStatistics
+from django_easyfilters.stats import update_field_stats
+
+try:
+    from django.apps import apps
+except ImportError:
+    # Django < 1.7
+    from django.db.models import get_model
+else:
+    get_model = apps.get_model
+
+
+def find_model(label):
+    """
+    Returns the model for 'app_label.ModelName', or None.
+    """
+    try:
+        app_label, model_name = label.split('.')
+        return get_model(app_label, model_name)
+    except (ValueError, LookupError):
+        return None
+
+
+class Command(BaseCommand):
+    args = '[<app_label.ModelName> [<field> ...]]'
+    help = ("Updates the catalogue of field statistics used by FilterSet.use_field_stats. "
+            "With a model, the statistics for the given fields, or all of its fields, "
+            "are updated. Otherwise, all the statistics already in the catalogue are "
+            "updated.")
+
+    def handle(self, *args, **options):
+        if args:
+            model = find_model(args[0])
+            if model is None:
+                raise CommandError("Unknown model %r" % args[0])
+            fields = list(args[1:])
+            if not fields:
+                opts = model._meta
+                fields = ([f.name for f in opts.fields if not f.primary_key] +
+                          [f.name for f in opts.many_to_many])
+            models_fields = [(model, f) for f in fields]
+        else:
+            models_fields = []
+            for obj in FieldStatistics.objects.all():
+                model = find_model(obj.model)
+                if model is not None:
+                    models_fields.append((model, obj.field))
+        for model, field in models_fields:
+            update_field_stats(model, field)
+            if int(options.get('verbosity', 1)) > 1:
+                self.stdout.write("Updated %s.%s.%s\n" % (model._meta.app_label,
+                                                         model._meta.object_name, field))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldStatistics',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('model', models.CharField(max_length=255)),
+                ('field', models.CharField(max_length=255)),
+                ('rows', models.BigIntegerField()),
+                ('distinct', models.BigIntegerField()),
+                ('lower', models.TextField(null=True, blank=True)),
+                ('upper', models.TextField(null=True, blank=True)),
+                ('null_fraction', models.FloatField()),
+                ('updated', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name_plural': 'field statistics',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fieldstatistics',
+            unique_together=set([('model', 'field')]),
+        ),
+    ]
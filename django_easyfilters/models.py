@@ -0,0 +1,31 @@
+from django.db import models
+
+# Connects the signal handlers that invalidate cached choices, in every
+# process that has the app installed.
+from django_easyfilters import cache  # NOQA
+from django_easyfilters.utils import python_2_unicode_compatible
+
+
+@python_2_unicode_compatible
+class FieldStatistics(models.Model):
+    """
+    Statistics about the values of a model field, over the whole table, used
+    by FilterSet to choose the kind of filter and options to use. See
+    django_easyfilters.stats.
+    """
+    model = models.CharField(max_length=255)  # 'app_label.ModelName'
+    field = models.CharField(max_length=255)
+    rows = models.BigIntegerField()
+    distinct = models.BigIntegerField()
+    # The minimum and maximum values, as text
+    lower = models.TextField(null=True, blank=True)
+    upper = models.TextField(null=True, blank=True)
+    null_fraction = models.FloatField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('model', 'field')]
+        verbose_name_plural = 'field statistics'
+
+    def __str__(self):
+        return '%s.%s' % (self.model, self.field)
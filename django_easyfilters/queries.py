@@ -1,12 +1,38 @@
+from contextlib import contextmanager
+from datetime import date
+import sys
+import uuid
+
 import django
 
-from django.db import models
-from django.db.backends.util import typecast_timestamp
+from django.conf import settings
+from django.db import connections, models
 from django.db.models.sql.compiler import SQLCompiler
 from django.db.models.sql.constants import MULTI
-from django.db.models.sql.datastructures import Date
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.sql.subqueries import AggregateQuery
 from django.utils.datastructures import SortedDict
+import six
+
+try:
+    from django.utils import timezone
+    from django.utils.dateparse import parse_date, parse_datetime
+except ImportError:
+    # Django < 1.4, which has no time zone support.
+    from datetime import datetime
+    timezone = None
+
+    def parse_datetime(value):
+        try:
+            return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+
+    def parse_date(value):
+        try:
+            return datetime.strptime(value[:10], '%Y-%m-%d').date()
+        except ValueError:
+            return None
 
 # try to import SelectInfo, appeared in django 1.6
 try:
@@ -15,88 +41,275 @@ except ImportError:
     SelectInfo = None
 
 
+DATE_ALIAS = 'easyfilter_date'
+
 # Some fairly brittle, low level stuff, to get the aggregation
 # queries we need.
 
 
-class DateAggregateQuery(AggregateQuery):
-    # Need to override to return a compiler not in django.db.models.sql.compiler
-    def get_compiler(self, using=None, connection=None):
-        return DateAggregateCompiler(self, connection, using)
+def date_histogram(qs, fieldname, kind):
+    """
+    Performs a query returning the number of rows in the QuerySet for each
+    value of the date/datetime field 'fieldname', truncated to 'kind' ('year',
+    'month' or 'day'). Yields (datetime, count) pairs in order of date.
 
-    def get_counts(self, using):
-        from django.db import connections
-        connection = connections[using]
-        return list(self.get_compiler(using, connection).results_iter())
+    The truncation is done by the database, with conversion to the current time
+    zone for datetime fields if USE_TZ is True, and rows are grouped by it
+    directly.
+    """
+    connection = connections[qs.db]
+    qn = connection.ops.quote_name
+    field = qs.model._meta.get_field(fieldname)
+    # The field may be inherited from a parent model, whose table is joined
+    # by the isnull filter below.
+    column = '%s.%s' % (qn(field.model._meta.db_table), qn(field.column))
+    tzinfo = None
+    if (isinstance(field, models.DateTimeField) and
+            hasattr(connection.ops, 'datetime_trunc_sql')):
+        # Django >= 1.6
+        tzname = None
+        if getattr(settings, 'USE_TZ', False):
+            tzinfo = timezone.get_current_timezone()
+            tzname = timezone._get_timezone_name(tzinfo)
+        sql, params = connection.ops.datetime_trunc_sql(kind, column, tzname)
+    else:
+        sql, params = connection.ops.date_trunc_sql(kind, column), []
 
+    rows = (qs
+            .filter(**{fieldname + '__isnull': False})
+            .extra(select={DATE_ALIAS: sql}, select_params=params)
+            .values_list(DATE_ALIAS)
+            .order_by(DATE_ALIAS)
+            .annotate(models.Count('pk')))
 
-class DateAggregateCompiler(SQLCompiler):
-    def results_iter(self):
-        needs_string_cast = self.connection.features.needs_datetime_string_cast
+    for value, count in rows.iterator():
+        if isinstance(value, six.string_types):
+            # e.g. SQLite
+            value = parse_datetime(value) or parse_date(value)
+        if tzinfo is not None and timezone.is_naive(value):
+            value = timezone.make_aware(value, tzinfo)
+        yield value, count
 
-        for rows in self.execute_sql(MULTI):
-            for row in rows:
-                if needs_string_cast:
-                    vals = [typecast_timestamp(str(row[0])),
-                            row[1]]
-                else:
-                    vals = row
-                yield vals
 
-    def as_sql(self, qn=None):
-        sql = ('SELECT %s, COUNT(%s) FROM (%s) subquery GROUP BY (%s) ORDER BY (%s)' % (
-            DateWithAlias.alias, DateWithAlias.alias, self.query.subquery,
-            DateWithAlias.alias, DateWithAlias.alias)
-        )
-        params = self.query.sub_params
-        return (sql, params)
+def value_counts(qs, fieldname, order_by_count=False, limit=None):
+    """
+    Performs a simple query returning the count of each value of
+    the field 'fieldname' in the QuerySet, returning the results
+    as a SortedDict of value: count
 
+    The results are in order of value, or of count (descending) if
+    order_by_count is True, and limited to 'limit' values if it is given.
+    """
+    if order_by_count:
+        values_counts = (qs.values_list(fieldname)
+                         .annotate(easyfilter_count=models.Count(fieldname))
+                         .order_by('-easyfilter_count', fieldname))
+    else:
+        values_counts = qs.values_list(fieldname).order_by(fieldname).annotate(models.Count(fieldname))
+    if limit is not None:
+        values_counts = values_counts[:limit]
+    count_dict = SortedDict()
+    for val, count in values_counts:
+        count_dict[val] = count
+    return count_dict
 
-class DateWithAlias(Date):
-    alias = 'easyfilter_date_alias'
 
-    def as_sql(self, qn, connection):
-        date = super(DateWithAlias, self).as_sql(qn, connection)
-        # Django 1.6 returns tuple not string, so we need to use check
-        if isinstance(date, (list, tuple)):
-            return date[0] + ' as ' + self.alias, date[1]
-        return date + ' as ' + self.alias
+# The number of values whose counts are fetched in each query by
+# capped_value_counts, and the most queries it runs.
+CAPPED_COUNTS_PER_QUERY = 100
+CAPPED_COUNTS_MAX_QUERIES = 5
 
 
-def date_aggregation(date_qs):
+def capped_value_counts(qs, fieldname, cap, values, limit=None):
     """
-    Performs an aggregation for a supplied DateQuerySet
+    Returns the count of each of 'values' for the field 'fieldname' in the
+    QuerySet, as a SortedDict of value: count, in the order of 'values' and
+    leaving out values that don't occur. Each value is counted using a
+    subquery that is LIMITed to cap + 1 rows, so that the database can stop
+    counting once the cap has been passed. Counts of more than 'cap' are
+    returned as cap + 1.
+
+    'values' must come from somewhere other than the rows of the QuerySet,
+    such as the choices for the field or the related table, and can be a list
+    or a QuerySet. It is read a slice at a time, until 'limit' values have
+    been found if it is given. If that takes more than
+    CAPPED_COUNTS_MAX_QUERIES queries, None is returned, and a single
+    value_counts() query is likely to be cheaper.
     """
-    # The DateQuerySet gives us a query that we need to clone and hack
-    date_q = date_qs.query.clone()
-    date_q.distinct = False
+    cursor = connections[qs.db].cursor()
+    count_dict = SortedDict()
+    start = 0
+    queries = 0
+    while limit is None or len(count_dict) < limit:
+        chunk = list(values[start:start + CAPPED_COUNTS_PER_QUERY])
+        if not chunk:
+            break
+        if queries == CAPPED_COUNTS_MAX_QUERIES:
+            return None
+        start += len(chunk)
+        parts, params = [], []
+        for i, value in enumerate(chunk):
+            if value is None:
+                # As with value_counts, which uses COUNT(field)
+                continue
+            subquery = qs.filter(**{fieldname: value}).values_list(fieldname).order_by()[:cap + 1]
+            try:
+                sql, subquery_params = subquery.query.get_compiler(qs.db).as_sql()
+            except EmptyResultSet:
+                # The QuerySet can't match anything, e.g. qs.none()
+                return count_dict
+            parts.append('SELECT %d, COUNT(*) FROM (%s) easyfilter_subquery%d' % (i, sql, i))
+            params.extend(subquery_params)
+        if not parts:
+            continue
+        cursor.execute(' UNION ALL '.join(parts), params)
+        queries += 1
+        counts = dict(cursor.fetchall())
+        for i, value in enumerate(chunk):
+            if counts.get(i) and (limit is None or len(count_dict) < limit):
+                count_dict[value] = counts[i]
+    return count_dict
 
-    # Replace 'select' to add an alias
-    date_obj = date_q.select[0]
 
-    # If it is django 1.6 generates new SelectInfo object
-    if SelectInfo and isinstance(date_obj, SelectInfo):
-        date_q.select = [SelectInfo(col=DateWithAlias(date_obj.col.col, date_obj.col.lookup_type), field=None)]
-    else:
-        date_q.select = [DateWithAlias(date_obj.col, date_obj.lookup_type)]
+def keyset_lookup(ordering, values):
+    """
+    Returns a Q object for the rows that come after a row in the order given
+    by 'ordering' (a list of field names, with '-' for descending), where
+    'values' are the values of those fields for that row. The fields must
+    identify a row uniquely, and the values must not be None.
+    """
+    q = None
+    for i, name in enumerate(ordering):
+        lookup = dict((n.lstrip('-'), v) for n, v in zip(ordering[:i], values[:i]))
+        lookup[name.lstrip('-') + ('__lt' if name.startswith('-') else '__gt')] = values[i]
+        q = models.Q(**lookup) if q is None else q | models.Q(**lookup)
+    return q
 
-    # Now use as a subquery to do aggregation
-    query = DateAggregateQuery(date_qs.model)
-    query.add_subquery(date_q, date_qs.db)
-    return query.get_counts(date_qs.db)
+
+def value_stats(qs, fieldname):
+    """
+    Performs a single query returning statistics for the values of the field
+    'fieldname' in the QuerySet, as a dictionary in the same form as
+    FacetBatch.value_stats.
+    """
+    return qs.order_by().aggregate(lower=models.Min(fieldname),
+                                   upper=models.Max(fieldname),
+                                   rows=models.Count('pk'),
+                                   count=models.Count(fieldname),
+                                   distinct=models.Count(fieldname, distinct=True))
 
 
-def value_counts(qs, fieldname):
+def can_materialize_ids(connection, reopen=False):
     """
-    Performs a simple query returning the count of each value of
-    the field 'fieldname' in the QuerySet, returning the results
-    as a SortedDict of value: count
+    Returns True if materialized_ids can create a temporary table on the
+    connection. If 'reopen' is True, the table must also be usable more than
+    once in a single statement, which MySQL doesn't allow.
     """
-    values_counts = qs.values_list(fieldname).order_by(fieldname).annotate(models.Count(fieldname))
-    count_dict = SortedDict()
-    for val, count in values_counts:
-        count_dict[val] = count
-    return count_dict
+    if reopen and connection.vendor == 'mysql':
+        return False
+    return connection.vendor in ('sqlite', 'postgresql', 'mysql')
+
+
+@contextmanager
+def materialized_ids(qs, reopen=False):
+    """
+    A context manager that stores the primary keys of the rows in the QuerySet
+    in a temporary table, and returns a QuerySet for the same rows that finds
+    them using that table, so that the filtering of the original QuerySet is
+    not repeated each time the new one is used. The table is dropped on exit.
+    'reopen' must be True if the new QuerySet will be used more than once in
+    the same statement, for example in a UNION.
+
+    If this isn't supported, the QuerySet is returned unchanged.
+    """
+    connection = connections[qs.db]
+    try:
+        sql, params = qs.values('pk').order_by().query.get_compiler(qs.db).as_sql()
+    except EmptyResultSet:
+        sql = None
+    if sql is None or not can_materialize_ids(connection, reopen=reopen):
+        yield qs
+        return
+
+    qn = connection.ops.quote_name
+    opts = qs.model._meta
+    table = 'easyfilter_ids_%s' % uuid.uuid4().hex[:16]
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE %s AS %s' % (qn(table), sql), params)
+    try:
+        # The table is only used for lookups by primary key.
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (qn(table + '_pk'), qn(table),
+                                                      qn(opts.pk.column)))
+        where = '%s.%s IN (SELECT %s FROM %s)' % (qn(opts.db_table), qn(opts.pk.column),
+                                                 qn(opts.pk.column), qn(table))
+        yield qs.model._base_manager.using(qs.db).extra(where=[where])
+    except BaseException:
+        exc_info = sys.exc_info()
+        # If the error aborted the transaction (with PostgreSQL) the DROP fails
+        # too, and that mustn't hide the original error. The table goes when
+        # the transaction is rolled back, or else at the end of the session.
+        try:
+            cursor.execute('DROP TABLE %s' % qn(table))
+        except Exception:
+            pass
+        six.reraise(*exc_info)
+    cursor.execute('DROP TABLE %s' % qn(table))
+
+
+def count_at_most(qs, limit):
+    """
+    Returns the number of rows in the QuerySet, or 'limit' if there are more
+    than that, without counting all of them.
+    """
+    # QuerySet.count() ignores the slice when counting, so the LIMIT has to go
+    # in a subquery.
+    try:
+        sql, params = qs.values('pk')[:limit].query.get_compiler(qs.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    cursor = connections[qs.db].cursor()
+    cursor.execute('SELECT COUNT(*) FROM (%s) easyfilter_subquery' % sql, params)
+    return cursor.fetchone()[0]
+
+
+def can_sample(model):
+    """
+    Returns True if sample_queryset can be used for the model, which needs an
+    integer primary key.
+    """
+    return isinstance(model._meta.pk, (models.AutoField, models.IntegerField))
+
+
+def sample_queryset(qs, modulus, fieldname=None):
+    """
+    Returns the QuerySet limited to rows whose primary key is a multiple of
+    'modulus', which for keys that are assigned sequentially is a
+    deterministic sample of about 1 in 'modulus' rows. If 'fieldname' is
+    given, the integer field or ForeignKey with that name is used instead of
+    the primary key.
+
+    The condition is raw SQL that refers to the model's table, so the result
+    can't be used in a subquery of another QuerySet.
+    """
+    connection = connections[qs.db]
+    qn = connection.ops.quote_name
+    opts = qs.model._meta
+    field = opts.pk if fieldname is None else opts.get_field(fieldname)
+    col = '%s.%s' % (qn(opts.db_table), qn(field.column))
+    if connection.vendor == 'oracle':
+        where = 'MOD(%s, %%s) = 0' % col
+    else:
+        where = '%s %%%% %%s = 0' % col
+    return qs.extra(where=[where], params=[modulus])
+
+
+def scale_counts(count_dict, factor):
+    """
+    Multiplies the counts in a dictionary of {value: count} by factor.
+    """
+    if factor == 1:
+        return count_dict
+    return SortedDict((val, count * factor) for val, count in count_dict.items())
 
 
 class NumericAggregateQuery(AggregateQuery):
@@ -125,45 +338,124 @@ class NumericAggregateCompiler(SQLCompiler):
         return (sql, params)
 
 
+def column_sql(col, qn):
+    """
+    Returns the SQL for a column taken from Query.select
+    """
+    if isinstance(col, (list, tuple)):
+        if hasattr(col, 'col'):
+            col = col.col
+        return '%s.%s' % tuple([qn(c) for c in col])
+    else:
+        return col
+
+
+def uniform_step(ranges):
+    """
+    Returns the step of 'ranges' if they are contiguous, in order, and all the
+    same size, or None otherwise.
+    """
+    step = ranges[0][1] - ranges[0][0]
+    if step <= 0:
+        return None
+    for i, r in enumerate(ranges):
+        if r[1] - r[0] != step or (i > 0 and r[0] != ranges[i - 1][1]):
+            return None
+    return step
+
+
+def is_contiguous(ranges):
+    return all(r[0] < r[1] and (i == 0 or r[0] == ranges[i - 1][1])
+               for i, r in enumerate(ranges))
+
+
+# Cache of the SQL for NumericValueRange, with RANGE_COL in place of the column
+# {(vendor, ranges): (sql, params)}
+_range_sql_cache = {}
+RANGE_SQL_CACHE_SIZE = 1000
+RANGE_COL = '{col}'
+
+
 class NumericValueRange(object):
     alias = 'easyfilter_number_range_alias'
 
     def __init__(self, col, ranges):
         # ranges is list of (lower, upper) bounds we want to find, where 'lower'
-        # is inclusive and upper is exclusive.
+        # is exclusive and upper is inclusive, except for the first item, where
+        # 'lower' is inclusive. The value is the index into ranges, or
+        # len(ranges) if the value is in none of them.
         self.col = col
-        self.ranges = ranges
+        self.ranges = [(r[0], r[1]) for r in ranges]
 
     # TODO - do we need 'relabel_aliases', like 'Date'?
 
     def as_sql(self, qn, connection):
-        if isinstance(self.col, (list, tuple)):
-            if hasattr(self.col, 'col'):
-                col = self.col.col
-            else:
-                col = self.col
-            col = '%s.%s' % tuple([qn(c) for c in col])
-        else:
-            col = self.col
-
-        # Build up case expression.
-        sql = ''.join(['CASE '] +
-                      ['WHEN %s > %%s AND %s <= %%s THEN %%s ' %
-                       (col, col) for val in self.ranges] +
-                      # An inclusive lower limit for the first item in ranges:
-                      [('WHEN %s = %%s THEN 0 ' % col) +
-                       ('ELSE %s END ') +
-                       ('as %s' % self.alias)])
-
-        params = []
-        for i, val in enumerate(self.ranges):
-            params.extend([val[0], val[1], i])
-        params.extend([self.ranges[0][0], len(self.ranges)])
-
+        key = (connection.vendor, tuple(self.ranges))
+        try:
+            sql, params = _range_sql_cache[key]
+        except KeyError:
+            sql, params = self.make_sql(connection.vendor)
+            if len(_range_sql_cache) >= RANGE_SQL_CACHE_SIZE:
+                _range_sql_cache.clear()
+            _range_sql_cache[key] = sql, params
+
+        sql = sql.replace(RANGE_COL, column_sql(self.col, qn)) + ' as %s' % self.alias
         if django.VERSION < (1, 6):
             return sql % tuple(params)
         else:
-            return sql, params
+            return sql, list(params)
+
+    def make_sql(self, vendor):
+        col = RANGE_COL
+        ranges = self.ranges
+        lower, upper = ranges[0][0], ranges[-1][1]
+        step = uniform_step(ranges)
+        if step is not None:
+            # Ranges from auto_ranges are uniform, so the index can be
+            # calculated as ceil((x - lower) / step) - 1.  '* 1.0' avoids
+            # integer division.
+            ratio = '((%s - %%s) * 1.0 / %%s)' % col
+            ratio_params = [lower, step]
+            if vendor == 'sqlite':
+                # SQLite has no CEIL, and stores decimals as floats, so we round
+                # away any error in the division before truncating.
+                ratio = 'ROUND(%s, 9)' % ratio
+                index = 'CAST(%s AS INTEGER) - (%s = CAST(%s AS INTEGER))' % (ratio, ratio, ratio)
+                index_params = ratio_params * 3
+            else:
+                index = 'CEIL(%s) - 1' % ratio
+                index_params = ratio_params
+        elif is_contiguous(ranges):
+            # Binary search, so each row needs log2(len(ranges)) comparisons.
+            index, index_params = self.bisect_sql(0, len(ranges))
+        else:
+            # Anything else is checked one range at a time.
+            sql = ''.join(['CASE '] +
+                          ['WHEN %s > %%s AND %s <= %%s THEN %%s ' %
+                           (col, col) for val in ranges] +
+                          # An inclusive lower limit for the first item in ranges:
+                          [('WHEN %s = %%s THEN 0 ' % col) +
+                           ('ELSE %s END')])
+            params = []
+            for i, val in enumerate(ranges):
+                params.extend([val[0], val[1], i])
+            params.extend([lower, len(ranges)])
+            return sql, tuple(params)
+
+        sql = ('CASE WHEN %s = %%s THEN 0 WHEN %s > %%s AND %s <= %%s THEN %s ELSE %%s END' %
+               (col, col, col, index))
+        params = [lower, lower, upper] + index_params + [len(ranges)]
+        return sql, tuple(params)
+
+    def bisect_sql(self, start, stop):
+        # SQL for the index of a value known to be in ranges[start:stop]
+        if stop - start == 1:
+            return '%s' % start, []
+        mid = (start + stop) // 2
+        sql_low, params_low = self.bisect_sql(start, mid)
+        sql_high, params_high = self.bisect_sql(mid, stop)
+        return ('CASE WHEN %s <= %%s THEN %s ELSE %s END' % (RANGE_COL, sql_low, sql_high),
+                [self.ranges[mid][0]] + params_low + params_high)
 
 
 def numeric_range_counts(qs, fieldname, ranges):
@@ -183,9 +475,201 @@ def numeric_range_counts(qs, fieldname, ranges):
     count_dict = SortedDict()
     for val, count in results:
         try:
-            r = ranges[val]
+            r = ranges[int(val)]
         except IndexError:
             # Include in the top range - this could be a rounding error
             r = ranges[-1]
         count_dict[r] = count
     return count_dict
+
+
+class ValueWithAlias(object):
+    alias = 'easyfilter_value_alias'
+    key_alias = 'easyfilter_key_alias'
+
+    def __init__(self, col, alias=None):
+        self.col = col
+        if alias is not None:
+            self.alias = alias
+
+    def as_sql(self, qn, connection):
+        sql = '%s as %s' % (column_sql(self.col, qn), self.alias)
+        if django.VERSION < (1, 6):
+            return sql
+        else:
+            return sql, []
+
+
+def value_subquery(qs, fieldname, keyname=None):
+    """
+    Returns the SQL and params for a query selecting just the values of
+    'fieldname' in the QuerySet, using the column alias ValueWithAlias.alias,
+    and the values of 'keyname' if it is given, using ValueWithAlias.key_alias
+    """
+    names = [fieldname] if keyname is None else [fieldname, keyname]
+    query = qs.values_list(*names).order_by().query.clone()
+    aliases = [ValueWithAlias.alias, ValueWithAlias.key_alias]
+    select = []
+    for select_obj, alias in zip(query.select, aliases):
+        if SelectInfo and isinstance(select_obj, SelectInfo):
+            select.append(SelectInfo(col=ValueWithAlias(select_obj, alias), field=None))
+        else:
+            select.append(ValueWithAlias(select_obj, alias))
+    query.select = select
+    return query.get_compiler(qs.db).as_sql()
+
+
+def value_field(model, fieldname):
+    """
+    Returns the field that determines the type of the values of 'fieldname'
+    (for a ForeignKey, this is the field on the related model).
+    """
+    field = model._meta.get_field(fieldname)
+    if field.rel is not None:
+        field = field.rel.get_related_field()
+    return field
+
+
+def convert_value(connection, value, field):
+    # Values come back from the batch query without the type information that
+    # the ORM normally uses, so they need coercing.
+    if isinstance(value, date):
+        return value
+    return connection.ops.convert_values(value, field)
+
+
+class BatchResult(object):
+    """
+    Placeholder for the results of one query in a FacetBatch, available
+    as 'value' once the batch has been executed.
+    """
+    value = None
+
+
+class FacetBatch(object):
+    """
+    Collects the count queries for a number of filters, and runs them against
+    the database as a single UNION ALL statement.
+
+    Each query gets its own 'value' columns in the combined statement, so that
+    the column types are consistent between the parts of the UNION, and all
+    queries share three integer columns for counts.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.parts = []
+
+    def __len__(self):
+        return len(self.parts)
+
+    def value_counts(self, qs, fieldname, key=None, conditions=()):
+        """
+        Adds a query equivalent to value_counts(qs, fieldname). The result is a
+        SortedDict of value: count.
+
+        If 'conditions' is given, only the rows whose value of the field 'key'
+        is in every one of the QuerySets in 'conditions' are counted, using
+        conditional aggregation. Filtering qs by them instead would make the
+        rows scanned different for each set of conditions.
+        """
+        return self.add_part(qs, fieldname, 'counts', key, conditions)
+
+    def value_stats(self, qs, fieldname):
+        """
+        Adds a query that returns statistics for the values of 'fieldname' in
+        the QuerySet. The result is a dictionary with keys 'lower', 'upper'
+        (the min and max), 'rows' (the number of rows), 'count' (the number of
+        non-NULL values) and 'distinct' (the number of distinct non-NULL
+        values).
+        """
+        return self.add_part(qs, fieldname, 'stats')
+
+    def add_part(self, qs, fieldname, kind, key=None, conditions=()):
+        result = BatchResult()
+        try:
+            sql, params = value_subquery(qs, fieldname, key if conditions else None)
+            condition = None
+            if conditions:
+                condition = ([], [])
+                for condition_qs in conditions:
+                    condition_sql, condition_params = (condition_qs.values_list('pk').order_by()
+                                                       .query.get_compiler(qs.db).as_sql())
+                    condition[0].append('subquery.%s IN (%s)' % (ValueWithAlias.key_alias,
+                                                                condition_sql))
+                    condition[1].extend(condition_params)
+        except EmptyResultSet:
+            # The QuerySet can't match anything, e.g. qs.none(), so it has no
+            # part in the statement.
+            if kind == 'stats':
+                result.value = dict(lower=None, upper=None, rows=0, count=0, distinct=0)
+            else:
+                result.value = SortedDict()
+            return result
+        self.parts.append((kind, sql, params,
+                           value_field(qs.model, fieldname), result, condition))
+        return result
+
+    def as_sql(self):
+        widths = [2 if part[0] == 'stats' else 1 for part in self.parts]
+        num_slots = sum(widths)
+        branches = []
+        params = []
+        offset = 0
+        for i, (kind, sql, part_params, field, result, condition) in enumerate(self.parts):
+            val = 'subquery.%s' % ValueWithAlias.alias
+            if kind == 'stats':
+                values = ['MIN(%s)' % val, 'MAX(%s)' % val]
+                counts = ['COUNT(*)', 'COUNT(%s)' % val, 'COUNT(DISTINCT %s)' % val]
+                group_by = ''
+            else:
+                values = [val]
+                if condition is None:
+                    counts = ['COUNT(%s)' % val, 'NULL', 'NULL']
+                else:
+                    counts = ['SUM(CASE WHEN %s IS NOT NULL AND %s THEN 1 ELSE 0 END)' % (
+                              val, ' AND '.join(condition[0])), 'NULL', 'NULL']
+                    params.extend(condition[1])
+                group_by = ' GROUP BY %s' % val
+            slots = (['NULL'] * offset + values +
+                     ['NULL'] * (num_slots - offset - len(values)))
+            branches.append('SELECT %s FROM (%s) subquery%s' % (
+                ', '.join([str(i)] + slots + counts), sql, group_by))
+            params.extend(part_params)
+            offset += len(values)
+        # Ordering on every column orders the rows of each part by its own
+        # value columns, because the columns of other parts are all NULL.
+        sql = '%s ORDER BY %s' % (' UNION ALL '.join(branches),
+                                  ', '.join(str(i + 1) for i in range(num_slots + 4)))
+        return sql, params
+
+    def execute(self):
+        if not self.parts:
+            return
+        connection = connections[self.using]
+        offsets = []
+        offset = 1
+        for kind, sql, params, field, result, condition in self.parts:
+            if kind == 'stats':
+                result.value = {}
+            else:
+                result.value = SortedDict()
+            offsets.append(offset)
+            offset += 2 if kind == 'stats' else 1
+        sql, params = self.as_sql()
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        for row in cursor.fetchall():
+            i = int(row[0])
+            kind, _, _, field, result, condition = self.parts[i]
+            if kind == 'stats':
+                lower, upper = row[offsets[i]:offsets[i] + 2]
+                rows, count, distinct = row[-3:]
+                result.value.update(lower=convert_value(connection, lower, field),
+                                    upper=convert_value(connection, upper, field),
+                                    rows=int(rows),
+                                    count=int(count),
+                                    distinct=int(distinct))
+            elif condition is None or row[-3]:
+                # Values whose rows don't meet the conditions are left out.
+                val = convert_value(connection, row[offsets[i]], field)
+                result.value[val] = int(row[-3])
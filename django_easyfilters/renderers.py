@@ -0,0 +1,74 @@
+"""
+Renderers that produce the HTML for filters without using the template engine.
+"""
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+import six
+
+from .filters import FILTER_ADD, FILTER_DISPLAY, FILTER_REMOVE
+from .filterset import non_breaking_spaces
+
+
+class FastRenderer(object):
+    """
+    Renders filters with the same markup as the template
+    'django-easyfilters/default.html', using string formatting.
+
+    To customise, override css_classes and choice_formats (or the methods)
+    on a subclass or instance.
+    """
+
+    # CSS classes, keyed by the part of the markup they are used for: 'line'
+    # and 'label' for the whole filter and its label, and the link types for
+    # the choices.
+    css_classes = {
+        'line': 'filterline',
+        'label': 'filterlabel',
+        FILTER_ADD: 'addfilter',
+        FILTER_REMOVE: 'removefilter',
+        FILTER_DISPLAY: 'displayfilter',
+    }
+
+    # The format strings for the choices of each link type. They are passed
+    # 'css_class', and 'label', 'url' and 'count', which are already escaped.
+    # The whitespace matches the output of the default template.
+    choice_formats = {
+        FILTER_ADD: (u'\n  \n    <span class="%(css_class)s"><a href="%(url)s" title="Add filter">'
+                     u'%(label)s&nbsp;(%(count)s)</a></span>&nbsp;&nbsp;\n  \n'),
+        FILTER_REMOVE: (u'\n  \n    \n    <span class="%(css_class)s"><a href="%(url)s" title="Remove filter">'
+                        u'%(label)s&nbsp;&laquo;&nbsp;</a></span>\n    \n  \n'),
+        FILTER_DISPLAY: (u'\n  \n    \n      <span class="%(css_class)s">%(label)s</span>\n    \n  \n'),
+    }
+
+    def render(self, filterlabel, choices):
+        """
+        Returns the HTML for a filter, given its label and list of FilterChoice
+        objects.
+        """
+        css_classes = self.css_classes
+        parts = [u'<div class="%s"><span class="%s">%s:</span>\n' % (
+            css_classes['line'], css_classes['label'], escape(filterlabel))]
+        parts.extend(self.render_choice(c) for c in choices)
+        parts.append(u'\n</div>\n')
+        return mark_safe(u''.join(parts))
+
+    def render_choice(self, choice):
+        return self.choice_formats[choice.link_type] % {
+            'css_class': self.css_classes[choice.link_type],
+            'label': non_breaking_spaces(choice.label),
+            'url': self.format_url(choice),
+            'count': self.format_count(choice),
+        }
+
+    def format_count(self, choice):
+        count = six.text_type(choice.count)
+        if choice.is_estimate:
+            count = u'~' + count
+        if choice.is_capped:
+            count += u'+'
+        return count
+
+    def format_url(self, choice):
+        if choice.link_type == FILTER_DISPLAY:
+            return None
+        return escape(u'?' + choice.query)
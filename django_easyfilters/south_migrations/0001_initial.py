@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        db.create_table(u'django_easyfilters_fieldstatistics', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('model', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('field', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('rows', self.gf('django.db.models.fields.BigIntegerField')()),
+            ('distinct', self.gf('django.db.models.fields.BigIntegerField')()),
+            ('lower', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('upper', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('null_fraction', self.gf('django.db.models.fields.FloatField')()),
+            ('updated', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal(u'django_easyfilters', ['FieldStatistics'])
+
+        db.create_unique(u'django_easyfilters_fieldstatistics', ['model', 'field'])
+
+    def backwards(self, orm):
+        db.delete_unique(u'django_easyfilters_fieldstatistics', ['model', 'field'])
+
+        db.delete_table(u'django_easyfilters_fieldstatistics')
+
+    models = {
+        u'django_easyfilters.fieldstatistics': {
+            'Meta': {'unique_together': "[('model', 'field')]", 'object_name': 'FieldStatistics'},
+            'distinct': ('django.db.models.fields.BigIntegerField', [], {}),
+            'field': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lower': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'null_fraction': ('django.db.models.fields.FloatField', [], {}),
+            'rows': ('django.db.models.fields.BigIntegerField', [], {}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {}),
+            'upper': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['django_easyfilters']
@@ -0,0 +1,133 @@
+"""
+A catalogue of statistics about the values of model fields, stored using the
+FieldStatistics model, so that a FilterSet can choose the cheapest kind of
+filter and options without running exploratory queries for every request.
+
+Statistics are filled in by the 'update_easyfilters_stats' management
+command, or when they are first needed. When they are older than a given time
+to live, they continue to be used while they are refreshed in the background.
+"""
+from datetime import datetime, timedelta
+import threading
+
+import six
+
+try:
+    from django.utils.timezone import now as current_time
+except ImportError:
+    # Django < 1.4
+    current_time = datetime.now
+
+from .cache import model_label, run_in_thread
+from .queries import value_stats
+
+# A process-local copy of the statistics, to save a query for each request.
+# {(model label, field name): (expiry datetime, stats dictionary)}
+_local = {}
+_local_lock = threading.Lock()
+
+
+def get_stats_field(model, field_name):
+    """
+    Returns (QuerySet, field name, field) for calculating the statistics of a
+    field, where 'field' converts the values. For a ManyToManyField, this
+    uses the intermediate table.
+    """
+    field, _, direct, m2m = model._meta.get_field_by_name(field_name)
+    if m2m and direct:
+        through = field.rel.through
+        fkey = [f for f in through._meta.fields
+                if f.rel is not None and f.rel.to is field.rel.to][0]
+        return through._default_manager.all(), fkey.name, field.rel.get_related_field()
+    if field.rel is not None:
+        return model._default_manager.all(), field_name, field.rel.get_related_field()
+    return model._default_manager.all(), field_name, field
+
+
+def compute_field_stats(model, field_name):
+    """
+    Calculates the statistics for a field over the whole table, as a
+    dictionary containing 'rows', 'distinct', 'lower', 'upper' and
+    'null_fraction'.
+    """
+    qs, stats_field_name, _ = get_stats_field(model, field_name)
+    stats = value_stats(qs, stats_field_name)
+    rows = stats['rows']
+    return {'rows': rows,
+            'distinct': stats['distinct'],
+            'lower': stats['lower'],
+            'upper': stats['upper'],
+            'null_fraction': float(rows - stats['count']) / rows if rows else 0.0}
+
+
+def update_field_stats(model, field_name):
+    """
+    Calculates and stores the statistics for a field, returning them.
+    """
+    from .models import FieldStatistics
+    stats = compute_field_stats(model, field_name)
+    label = model_label(model)
+    try:
+        obj = FieldStatistics.objects.get(model=label, field=field_name)
+    except FieldStatistics.DoesNotExist:
+        obj = FieldStatistics(model=label, field=field_name)
+    obj.rows = stats['rows']
+    obj.distinct = stats['distinct']
+    obj.lower = None if stats['lower'] is None else six.text_type(stats['lower'])
+    obj.upper = None if stats['upper'] is None else six.text_type(stats['upper'])
+    obj.null_fraction = stats['null_fraction']
+    obj.updated = current_time()
+    obj.save()
+    with _local_lock:
+        _local.pop((label, field_name), None)
+    return stats
+
+
+def stats_from_object(model, obj):
+    field = get_stats_field(model, obj.field)[2]
+    return {'rows': obj.rows,
+            'distinct': obj.distinct,
+            'lower': None if obj.lower is None else field.to_python(obj.lower),
+            'upper': None if obj.upper is None else field.to_python(obj.upper),
+            'null_fraction': obj.null_fraction}
+
+
+def refresh_in_background(model, field_name):
+    """
+    Updates the statistics for a field in a background thread.
+    """
+    run_in_thread(model._default_manager.db, update_field_stats, model, field_name)
+
+
+def get_field_stats(model, field_name, ttl, refresh=refresh_in_background):
+    """
+    Returns the statistics for a field from the catalogue. They are calculated
+    if they are missing. If they are more than 'ttl' seconds old, the old
+    statistics are returned, and refresh(model, field_name) is called by one
+    process to update them.
+    """
+    from .models import FieldStatistics
+    key = (model_label(model), field_name)
+    now = current_time()
+    local = _local.get(key)
+    if local is not None and local[0] > now:
+        return local[1]
+    try:
+        obj = FieldStatistics.objects.get(model=key[0], field=field_name)
+    except FieldStatistics.DoesNotExist:
+        obj = None
+    if obj is None:
+        stats = update_field_stats(model, field_name)
+        expires = now + timedelta(seconds=ttl)
+    else:
+        stats = stats_from_object(model, obj)
+        expires = obj.updated + timedelta(seconds=ttl)
+        if expires <= now:
+            # Moving 'updated' on first makes sure that only one process does
+            # the refresh, and the others keep using the old statistics.
+            if FieldStatistics.objects.filter(pk=obj.pk, updated=obj.updated).update(updated=now):
+                refresh(model, field_name)
+            expires = now + timedelta(seconds=ttl)
+    with _local_lock:
+        _local[key] = (expires, stats)
+    return stats
@@ -50,3 +50,7 @@ class Book(models.Model):
 class Person(models.Model):
     date_of_birth = models.DateField()
     name = models.CharField(max_length=50)
+
+
+class Employee(Person):
+    employer = models.CharField(max_length=50)
@@ -1,21 +1,53 @@
 # -*- coding: utf-8; -*-
 
-from datetime import date
+from datetime import date, timedelta
 from decimal import Decimal
+import json
 import operator
 import re
 
+from django.core.management import call_command
+from django.db import connection
 from django.http import QueryDict
 from django.test import TestCase
 from django.utils.datastructures import MultiValueDict
 from six import text_type
 
-from django_easyfilters.filterset import FilterSet
+from django_easyfilters import cache, filters, queries, stats
+from django_easyfilters.cache import get_cache
+from django_easyfilters.filterset import FilterSet, FutureTimeoutError
 from django_easyfilters.filters import \
-    FILTER_ADD, FILTER_REMOVE, FILTER_DISPLAY, \
-    ForeignKeyFilter, ValuesFilter, ChoicesFilter, ManyToManyFilter, DateTimeFilter, NumericRangeFilter
-
-from .models import Book, Genre, Author, BINDING_CHOICES, Person
+    FILTER_ADD, FILTER_REMOVE, FILTER_DISPLAY, FilterChoice, \
+    ForeignKeyFilter, ValuesFilter, ChoicesFilter, ManyToManyFilter, DateTimeFilter, NumericRangeFilter, \
+    EMPTY_RANGE, intersect_range_lookups
+from django_easyfilters.models import FieldStatistics
+from django_easyfilters.queries import \
+    can_materialize_ids, date_histogram, materialized_ids, numeric_range_counts, \
+    sample_queryset
+from django_easyfilters.ranges import auto_ranges
+from django_easyfilters.renderers import FastRenderer
+
+from .models import Book, Genre, Author, BINDING_CHOICES, Person, Employee
+
+
+class CaptureQueries(object):
+    """
+    Context manager that records the queries run on the connection in
+    'captured_queries'. (django.test.utils.CaptureQueriesContext needs
+    Django 1.6)
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.use_debug_cursor
+        self.captured_queries = self.connection.queries[self.start:]
 
 
 class TestFilterSet(TestCase):
@@ -145,6 +177,719 @@ class TestFilterSet(TestCase):
         f = BookFilterSet(qs, data)
         self.assertEqual(f.title, "Classics")
 
+    def test_compile(self):
+        """
+        Tests that the filter specs and field information are computed once
+        per FilterSet class and model.
+        """
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre', 'price']
+
+        self.assertEqual([(name, klass) for name, klass, opts in BookFilterSet.compile(Book)],
+                         [('binding', ChoicesFilter),
+                          ('genre', ForeignKeyFilter),
+                          ('price', NumericRangeFilter)])
+        fs1 = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs2 = BookFilterSet(Book.objects.all(), QueryDict('price=3.50i..5.00i'))
+        self.assertTrue(fs1.filters[0].choices_dict is fs2.filters[0].choices_dict)
+        self.assertTrue(fs1.filters[2].choice_type is fs2.filters[2].choice_type)
+        self.assertEqual(len(fs2.filters[2].chosen), 1)
+        self.assertFalse('_compiled_specs' in FilterSet.__dict__)
+
+    def test_template_cache(self):
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre']
+            template = u'<b>{{ filterlabel }}</b>{% for choice in choices %}{{ choice.label }}{% endfor %}'
+
+        fs1 = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs2 = BookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+        self.assertTrue(fs1.get_template('genre') is fs2.get_template('genre'))
+        rendered = fs1.render()
+        self.assertEqual(rendered.count(u'<b>'), 2)
+        self.assertTrue(u'<b>Binding</b>' in rendered)
+        self.assertTrue(u'<b>Genre</b>' in rendered)
+        self.assertEqual(fs1.render_filter(fs1.filters[1]), rendered.split(u'\n')[1])
+
+    def test_fast_renderer(self):
+        """
+        Tests that FastRenderer produces the same output as the default
+        template.
+        """
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre', 'authors', 'date_published', 'price', 'rating']
+
+        class FastBookFilterSet(BookFilterSet):
+            renderer = FastRenderer()
+
+        for params in ['', 'binding=H', 'binding=H&date_published=1818',
+                       'date_published=1813..1850&genre=1', 'price=3.50i..5.00i&authors=2']:
+            self.assertEqual(BookFilterSet(Book.objects.all(), QueryDict(params)).render(),
+                             FastBookFilterSet(Book.objects.all(), QueryDict(params)).render())
+
+    def test_fast_renderer_customise(self):
+        renderer = FastRenderer()
+        renderer.css_classes = dict(renderer.css_classes, line='facet')
+
+        class BookFilterSet(FilterSet):
+            fields = ['binding']
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        fs.renderer = renderer
+        rendered = fs.render()
+        self.assertTrue(rendered.startswith(u'<div class="facet">'))
+        self.assertTrue(u'class="addfilter"' in rendered)
+
+    def test_as_data(self):
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre']
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+        data = fs.as_data()
+        self.assertEqual([f['field'] for f in data['filters']], ['binding', 'genre'])
+        binding, genre = data['filters']
+        self.assertEqual(binding['label'], 'Binding')
+        self.assertEqual(binding['choices'],
+                         [{'label': 'Hardback', 'count': None, 'link_type': FILTER_REMOVE, 'query': '',
+                           'is_estimate': False, 'is_capped': False}])
+        choices = fs.get_filter_choices('genre')
+        self.assertEqual([(c['label'], c['count'], c['link_type'], sorted(QueryDict(c['query']).lists()))
+                          for c in genre['choices']],
+                         [(c.label, c.count, c.link_type, sorted(c.params.lists())) for c in choices])
+        self.assertEqual(json.loads(fs.to_json()), data)
+
+    def test_as_data_fingerprint(self):
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre']
+
+        fingerprint = BookFilterSet(Book.objects.all(), QueryDict('')).as_data()['fingerprint']
+        data = BookFilterSet(Book.objects.all(), QueryDict('')).as_data(fingerprint=fingerprint)
+        self.assertEqual(data['fingerprint'], fingerprint)
+        self.assertTrue(all(f['unchanged'] and 'choices' not in f for f in data['filters']))
+
+        data = BookFilterSet(Book.objects.all(), QueryDict('binding=H')).as_data(fingerprint=fingerprint)
+        self.assertNotEqual(data['fingerprint'], fingerprint)
+        self.assertTrue(all('choices' in f for f in data['filters']))
+
+    def test_data_view(self):
+        response = self.client.get('/books-filters/', {'binding': 'H'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['filters'][0]['choices'][0]['link_type'], FILTER_REMOVE)
+
+        response = self.client.get('/books-filters/', {'binding': 'H',
+                                                        'fingerprint': data['fingerprint']})
+        data2 = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data2['fingerprint'], data['fingerprint'])
+        self.assertTrue(all(f.get('unchanged') for f in data2['filters']))
+
+    def test_lazy_links(self):
+        """
+        Tests that the querystrings for choices are the same as from params.
+        """
+        params = QueryDict('authors=2&page=2&other=a+b%26c')
+        f = ManyToManyFilter('authors', Book, params)
+        choices = f.get_choices(f.apply_filter(Book.objects.all()))
+        self.assertTrue(len(choices) > 2)
+        for c in choices:
+            if c.link_type == FILTER_DISPLAY:
+                self.assertEqual(c.query, None)
+                continue
+            query = QueryDict(c.query)
+            self.assertEqual(sorted(query.lists()), sorted(c.params.lists()))
+            self.assertFalse('page' in query)
+            self.assertEqual(query['other'], 'a b&c')
+
+        # Choices can still be used as tuples.
+        c = choices[-1]
+        label, count, params, link_type = c
+        self.assertEqual((label, count, link_type), (c.label, c.count, c.link_type))
+        self.assertEqual(params, c.params)
+        self.assertEqual(c[2], c.params)
+        self.assertEqual(c[:2], (c.label, c.count))
+        self.assertEqual(c, tuple(c))
+        self.assertEqual(c._replace(count=100).count, 100)
+        display = FilterChoice('x', 1, None, FILTER_DISPLAY, is_estimate=True)
+        self.assertEqual(len(set([display, tuple(display)])), 1)
+        self.assertTrue(display._replace(is_capped=True).is_estimate)
+
+    def test_lazy_choices(self):
+        """
+        Tests that the choices for each filter are only computed when needed.
+        """
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'genre', 'authors', 'price']
+            title_fields = ['binding']
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict('binding=H'))
+        with self.assertNumQueries(0):
+            self.assertEqual(fs.title, 'Hardback')
+        with self.assertNumQueries(1):
+            fs.get_filter_choices('genre')
+        with self.assertNumQueries(0):
+            fs.get_filter_choices('genre')
+
+        # Truthiness stops at the first filter with choices.
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        with self.assertNumQueries(1):
+            self.assertTrue(fs)
+        fs = BookFilterSet(Book.objects.none(), QueryDict(''))
+        self.assertFalse(fs)
+
+    def test_has_choices(self):
+        """
+        Tests that Filter.has_choices agrees with get_choices.
+        """
+        qs = Book.objects.all()
+        for field, filter_class in [('binding', ChoicesFilter),
+                                    ('edition', ValuesFilter),
+                                    ('genre', ForeignKeyFilter),
+                                    ('authors', ManyToManyFilter),
+                                    ('date_published', DateTimeFilter),
+                                    ('rating', NumericRangeFilter)]:
+            for params in [{}, {'binding': ['H']}, {field: ['1']}, {field: ['10000']}]:
+                f = filter_class(field, Book, MultiValueDict(params))
+                for qs_filtered in [f.apply_filter(qs), f.apply_filter(qs.filter(binding='P')),
+                                    f.apply_filter(qs.filter(id=10000))]:
+                    self.assertEqual(f.has_choices(qs_filtered), len(f.get_choices(qs_filtered)) > 0)
+
+    def test_batch_counts(self):
+        """
+        Tests that batch_counts doesn't change the choices produced.
+        """
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'authors',
+                'genre',
+                'price',
+                'date_published',
+                'rating',
+                'edition',
+            ]
+
+        class BatchedBookFilterSet(BookFilterSet):
+            batch_counts = True
+
+        qs = Book.objects.all()
+        for query in ['', 'genre=6', 'authors=2', 'price=3.50i..5.00i',
+                      'date_published=1818', 'binding=H&rating=4.0']:
+            fs1 = BookFilterSet(qs, QueryDict(query))
+            fs2 = BatchedBookFilterSet(qs, QueryDict(query))
+            for field in BookFilterSet.fields:
+                self.assertEqual(fs1.get_filter_choices(field),
+                                 fs2.get_filter_choices(field))
+
+    def test_batch_counts_empty(self):
+        """
+        Tests that batch_counts works when the QuerySet can't match anything,
+        which Django doesn't send to the database.
+        """
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'authors',
+                'genre',
+                'price',
+                'date_published',
+                'edition',
+            ]
+
+        class BatchedBookFilterSet(BookFilterSet):
+            batch_counts = True
+
+        for qs, query in [(Book.objects.none(), ''),
+                          (Book.objects.all(), 'price=0i..1i&price=5i..6i'),
+                          (Book.objects.all(), 'date_published=1990&date_published=1991-02')]:
+            fs1 = BookFilterSet(qs, QueryDict(query))
+            fs2 = BatchedBookFilterSet(qs, QueryDict(query))
+            for field in BookFilterSet.fields:
+                self.assertEqual(fs1.get_filter_choices(field),
+                                 fs2.get_filter_choices(field))
+            self.assertEqual(fs1.render(), fs2.render())
+
+    def test_batch_counts_queries(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'edition',
+                'price',
+            ]
+            batch_counts = True
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        # 1 query for all the counts, 1 for the price ranges
+        with self.assertNumQueries(2):
+            fs.render()
+
+    def test_materialize_ids(self):
+        """
+        Tests that materialize_min_filters doesn't change the choices produced,
+        and that the count queries don't repeat the filtering.
+        """
+        class BookFilterSet(FilterSet):
+            fields = [
+                'binding',
+                'authors',
+                'genre',
+                'price',
+                'date_published',
+                'rating',
+                'edition',
+            ]
+
+        class MaterializedBookFilterSet(BookFilterSet):
+            materialize_min_filters = 2
+
+        class BatchedBookFilterSet(MaterializedBookFilterSet):
+            batch_counts = True
+
+        qs = Book.objects.filter(name__icontains='e')
+        for query in ['', 'genre=1', 'authors=2', 'binding=H&rating=4.0']:
+            fs1 = BookFilterSet(qs, QueryDict(query))
+            for fs2 in [MaterializedBookFilterSet(qs, QueryDict(query)),
+                        BatchedBookFilterSet(qs, QueryDict(query))]:
+                for field in BookFilterSet.fields:
+                    self.assertEqual(fs1.get_filter_choices(field),
+                                     fs2.get_filter_choices(field))
+
+        fs = MaterializedBookFilterSet(qs, QueryDict(''))
+        with CaptureQueries(connection) as ctx:
+            fs.render()
+        sql = [q['sql'] for q in ctx.captured_queries]
+        self.assertIn('CREATE TEMPORARY TABLE', sql[0])
+        self.assertIn('CREATE INDEX', sql[1])
+        self.assertIn('DROP TABLE', sql[-1])
+        self.assertEqual(len([s for s in sql if 'LIKE' in s]), 1)
+
+        # MySQL can't use a temporary table twice in one statement.
+        class MySQLConnection(object):
+            vendor = 'mysql'
+        self.assertTrue(can_materialize_ids(MySQLConnection()))
+        self.assertFalse(can_materialize_ids(MySQLConnection(), reopen=True))
+
+        # Not enough filters
+        fs = MaterializedBookFilterSet(qs, QueryDict(''))
+        fs.filters = fs.filters[:1]
+        with CaptureQueries(connection) as ctx:
+            fs.render()
+        self.assertFalse(any('TEMPORARY' in q['sql'] for q in ctx.captured_queries))
+
+        # An error from dropping the table doesn't hide the one that caused it.
+        def use_ids():
+            with CaptureQueries(connection) as ctx:
+                with materialized_ids(qs):
+                    table = re.search(r'CREATE TEMPORARY TABLE "(\w+)"',
+                                      connection.queries[ctx.start]['sql']).group(1)
+                    connection.cursor().execute('DROP TABLE "%s"' % table)
+                    raise ValueError()
+        self.assertRaises(ValueError, use_ids)
+
+    def test_disjunctive_counts(self):
+        class BookFilterSet(FilterSet):
+            fields = ['binding', ('authors', {'match': 'any'}), 'date_published']
+
+        class DisjunctiveBookFilterSet(BookFilterSet):
+            disjunctive_counts = True
+
+        class BatchedBookFilterSet(DisjunctiveBookFilterSet):
+            batch_counts = True
+
+        qs = Book.objects.all()
+        params = QueryDict('binding=P&authors=2&date_published=1818')
+        authors = ManyToManyFilter('authors', Book, params, match='any')
+        # The counts for authors only have the other filters applied.
+        other_qs = qs.filter(binding='P', date_published__year=1818)
+        expected = authors.get_choices(other_qs)
+        self.assertNotEqual(expected, authors.get_choices(authors.apply_filter(other_qs)))
+        for filterset_class in [DisjunctiveBookFilterSet, BatchedBookFilterSet]:
+            fs = filterset_class(qs, params)
+            self.assertEqual(fs.get_filter_choices('authors'), expected)
+            # Other filters don't allow it.
+            for field in ['binding', 'date_published']:
+                self.assertEqual(fs.get_filter_choices(field),
+                                 BookFilterSet(qs, params).get_filter_choices(field))
+
+    def test_disjunctive_counts_conditional(self):
+        # With several filters whose own choices are left out, their counts
+        # are found from the same rows using conditional aggregation.
+        class AnyValuesFilter(ValuesFilter):
+            allows_disjunctive_counts = True
+
+            def apply_filter(self, qs):
+                if not self.chosen:
+                    return qs
+                return qs.filter(**{self.field + '__in': list(self.chosen)})
+
+            def get_choices(self, qs):
+                return self.get_choices_remove(qs) + self.get_choices_add(qs)
+
+        fields = [('binding', {}, AnyValuesFilter),
+                  ('edition', {}, AnyValuesFilter),
+                  ('authors', {'match': 'any'}),
+                  'genre']
+
+        class BookFilterSet(FilterSet):
+            disjunctive_counts = True
+
+            def get_fields(self):
+                return fields
+
+        class BatchedBookFilterSet(BookFilterSet):
+            batch_counts = True
+
+        qs = Book.objects.all()
+        for query in ['binding=P&edition=1&authors=2', 'binding=H&authors=2&authors=3',
+                      'binding=H&binding=P&edition=2&genre=1', 'edition=3&edition=1']:
+            params = QueryDict(query)
+            fs = BookFilterSet(qs, params)
+            # The counts for each filter have only the other filters applied.
+            expected = {}
+            for f in fs.filters:
+                other_qs = qs
+                for other in fs.filters:
+                    if other is not f and (other.allows_disjunctive_counts or
+                                           f.allows_disjunctive_counts):
+                        other_qs = other.apply_filter(other_qs)
+                if not f.allows_disjunctive_counts:
+                    other_qs = f.apply_filter(other_qs)
+                fresh = BookFilterSet(qs, params).filters[fs.filters.index(f)]
+                expected[f.field] = fresh.get_choices(other_qs)
+            for filterset_class in [BookFilterSet, BatchedBookFilterSet]:
+                fs = filterset_class(qs, params)
+                with CaptureQueries(connection) as ctx:
+                    choices = dict((f.field, fs.get_filter_choices(f.field)) for f in fs.filters)
+                self.assertEqual(choices, expected, query)
+                self.assertEqual(len([q for q in ctx.captured_queries
+                                      if 'CASE WHEN' in q['sql']]),
+                                 1 if len(fs.get_disjunctive_filters()) > 1 else 0)
+
+    def test_disjunctive_counts_match_links(self):
+        # The count for each choice must be the number of items that its link
+        # finds, which only allows disjunctive counts when choices are ORed.
+        class BookFilterSet(FilterSet):
+            fields = ['binding', 'authors', 'genre', 'price']
+            disjunctive_counts = True
+
+        qs = Book.objects.all()
+        for query in ['authors=2', 'authors=2&binding=H', 'genre=1&authors=2&authors=3']:
+            fs = BookFilterSet(qs, QueryDict(query))
+            for f in fs.filters:
+                for c in fs.get_filter_choices(f.field):
+                    if c.link_type == FILTER_ADD:
+                        self.assertEqual(c.count, BookFilterSet(qs, c.params).qs.count(),
+                                         "%s %s: %s" % (query, f.field, c.label))
+
+    def test_manytomany_match_any(self):
+        class BookFilterSet(FilterSet):
+            fields = [('authors', {'match': 'any'})]
+            disjunctive_counts = True
+
+        qs = Book.objects.all()
+        params = QueryDict('authors=2')
+        fs = BookFilterSet(qs, params)
+        filter_ = fs.filters[0]
+        self.assertEqual(set(fs.qs), set(qs.filter(authors=2)))
+        for c in fs.get_filter_choices('authors'):
+            if c.link_type == FILTER_ADD:
+                value = filter_.choice_value_param(c)
+                # The count is the number of items related to that object,
+                # with the other filters applied.
+                self.assertEqual(c.count, qs.filter(authors=value).count())
+                # The link finds items related to either of the objects.
+                self.assertEqual(set(BookFilterSet(qs, c.params).qs),
+                                 set(qs.filter(authors__in=[2, value])))
+
+
+class TestCaching(TestCase):
+
+    fixtures = ['django_easyfilters_tests']
+
+    def setUp(self):
+        get_cache('default').clear()
+
+    def test_cached_choices(self):
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+                'authors',
+                'price',
+            ]
+            cache_timeout = 60
+
+        qs = Book.objects.all()
+        fs1 = BookFilterSet(qs, QueryDict('price=3.50i..5.00i'))
+        choices1 = [fs1.get_filter_choices(f) for f in BookFilterSet.fields]
+
+        # Links are rebuilt from the current params
+        fs2 = BookFilterSet(qs, QueryDict('price=3.50i..5.00i&page=2&other=x'))
+        with self.assertNumQueries(0):
+            choices2 = [fs2.get_filter_choices(f) for f in BookFilterSet.fields]
+        self.assertEqual([[(c.label, c.count, c.link_type) for c in cs] for cs in choices1],
+                         [[(c.label, c.count, c.link_type) for c in cs] for cs in choices2])
+        for c in choices2[0]:
+            self.assertEqual(c.params['other'], 'x')
+            self.assertTrue('page' not in c.params)
+
+        # Changes to related models invalidate the cache
+        genre = Genre.objects.get(id=6)
+        genre.name = 'Old stuff'
+        genre.save()
+        fs3 = BookFilterSet(qs, QueryDict('price=3.50i..5.00i'))
+        self.assertTrue('Old stuff' in [c.label for c in fs3.get_filter_choices('genre')])
+
+        # Including m2m changes
+        book = Book.objects.filter(price__gte=Decimal('3.50'), price__lte=Decimal('5.00'))[0]
+        new_author = Author.objects.create(name='Nobody')
+        book.authors.add(new_author)
+        fs4 = BookFilterSet(qs, QueryDict('price=3.50i..5.00i'))
+        self.assertTrue('Nobody' in [c.label for c in fs4.get_filter_choices('authors')])
+
+    def test_invalidation_without_watching(self):
+        # Changes invalidate cached choices even if they are made in a process
+        # that hasn't used the model with a FilterSet.
+        self.assertNotIn(Person, cache._watched)
+        version = cache.get_versions(get_cache('default'), [Person])
+        Person.objects.create(name="Joe", date_of_birth=date(2011, 1, 10))
+        self.assertNotEqual(cache.get_versions(get_cache('default'), [Person]), version)
+
+    def test_cache_keys_callable_options(self):
+        # Functions are identified by name, so that the keys are the same in
+        # every process.
+        def make_filterset():
+            def genre_label(row):
+                return row['name'].upper()
+
+            class BookFilterSet(FilterSet):
+                fields = [
+                    ('genre', dict(label_func=genre_label)),
+                ]
+                cache_timeout = 60
+
+            return BookFilterSet(Book.objects.all(), QueryDict(''))
+
+        fs1 = make_filterset()
+        fs2 = make_filterset()
+        self.assertNotEqual(fs1.filters[0].label_func, fs2.filters[0].label_func)
+        self.assertEqual(fs1.get_cache_keys(fs1.filters), fs2.get_cache_keys(fs2.filters))
+        choices = fs1.get_filter_choices('genre')
+        with self.assertNumQueries(0):
+            self.assertEqual([c.label for c in fs2.get_filter_choices('genre')],
+                             [c.label for c in choices])
+
+    def test_stale_while_revalidate(self):
+        revalidated = []
+
+        class BookFilterSet(FilterSet):
+            fields = [
+                'genre',
+            ]
+            cache_timeout = 0
+            cache_stale_timeout = 60
+
+            def revalidate_choices(self, filters):
+                revalidated.extend(f.field for f in filters)
+                self.refresh_cached_choices(filters)
+
+        qs = Book.objects.all()
+        choices1 = BookFilterSet(qs, QueryDict('')).get_filter_choices('genre')
+        self.assertEqual(revalidated, [])
+
+        # Stale choices are served, and updated
+        with self.assertNumQueries(1):
+            choices2 = BookFilterSet(qs, QueryDict('')).get_filter_choices('genre')
+        self.assertEqual(choices1, choices2)
+        self.assertEqual(revalidated, ['genre'])
+
+        # Only one update is done at a time
+        BookFilterSet(qs, QueryDict('')).get_filter_choices('genre')
+        self.assertEqual(revalidated, ['genre'])
+
+
+class InlineFuture(object):
+    def __init__(self, result=None, done=True):
+        self._result = result
+        self._done = done
+        self.cancelled = False
+
+    def result(self, timeout=None):
+        if not self._done:
+            raise FutureTimeoutError()
+        return self._result
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class InlineExecutor(object):
+    """
+    Executor that runs tasks immediately, apart from those for 'slow_fields'
+    which never finish.
+    """
+    def __init__(self, slow_fields=()):
+        self.slow_fields = slow_fields
+        self.futures = []
+
+    def submit(self, fn, filter_):
+        if filter_.field in self.slow_fields:
+            future = InlineFuture(done=False)
+        else:
+            future = InlineFuture(fn(filter_))
+        self.futures.append(future)
+        return future
+
+
+class TestExecutor(TestCase):
+
+    fixtures = ['django_easyfilters_tests']
+
+    class BookFilterSet(FilterSet):
+        fields = [
+            'binding',
+            'genre',
+            'authors',
+            'date_published',
+        ]
+
+    def test_executor(self):
+        qs = Book.objects.all()
+        executor = InlineExecutor()
+        fs1 = self.BookFilterSet(qs, QueryDict('genre=6'))
+        fs2 = self.BookFilterSet(qs, QueryDict('genre=6'), executor=executor)
+        for field in self.BookFilterSet.fields:
+            self.assertEqual(fs1.get_filter_choices(field),
+                             fs2.get_filter_choices(field))
+        self.assertEqual(len(executor.futures), 4)
+        self.assertEqual(fs1.render(), fs2.render())
+
+    def test_deadline(self):
+        class BookFilterSet(self.BookFilterSet):
+            choices_deadline = 0.5
+
+        executor = InlineExecutor(slow_fields=['authors'])
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''), executor=executor)
+        self.assertEqual(fs.get_filter_choices('authors'), [])
+        self.assertTrue(len(fs.get_filter_choices('genre')) > 0)
+        self.assertEqual(fs.timed_out_fields, ['authors'])
+        self.assertTrue(executor.futures[2].cancelled)
+        self.assertTrue('Authors' in fs.render())
+
+
+class TestFieldStats(TestCase):
+
+    fixtures = ['django_easyfilters_tests']
+
+    def setUp(self):
+        stats._local.clear()
+
+    def test_compute_field_stats(self):
+        books = Book.objects.all()
+        edition = stats.compute_field_stats(Book, 'edition')
+        self.assertEqual(edition, {'rows': books.count(),
+                                   'distinct': 3,
+                                   'lower': 1,
+                                   'upper': 3,
+                                   'null_fraction': 0.0})
+        rating = stats.compute_field_stats(Book, 'rating')
+        self.assertEqual(rating['null_fraction'],
+                         float(books.filter(rating__isnull=True).count()) / books.count())
+        authors = stats.compute_field_stats(Book, 'authors')
+        self.assertEqual(authors['distinct'], Author.objects.filter(book__isnull=False).distinct().count())
+
+    def test_get_field_stats(self):
+        with self.assertNumQueries(4):
+            # Lookup, calculate, then insert
+            price = stats.get_field_stats(Book, 'price', 60)
+        self.assertEqual(price['lower'], Book.objects.order_by('price')[0].price)
+        with self.assertNumQueries(0):
+            self.assertEqual(stats.get_field_stats(Book, 'price', 60), price)
+
+        # Stored in the DB
+        stats._local.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(stats.get_field_stats(Book, 'price', 60), price)
+
+        # When old, they are still used, and one process refreshes them.
+        refreshed = []
+        refresh = lambda model, field_name: refreshed.append((model, field_name))
+        FieldStatistics.objects.update(updated=FieldStatistics.objects.get().updated - timedelta(seconds=61))
+        FieldStatistics.objects.update(rows=0)
+        stats._local.clear()
+        with self.assertNumQueries(2):
+            self.assertEqual(stats.get_field_stats(Book, 'price', 60, refresh=refresh)['rows'], 0)
+        self.assertEqual(refreshed, [(Book, 'price')])
+        stats._local.clear()
+        with self.assertNumQueries(1):
+            stats.get_field_stats(Book, 'price', 60, refresh=refresh)
+        self.assertEqual(len(refreshed), 1)
+        self.assertEqual(FieldStatistics.objects.count(), 1)
+
+    def test_management_command(self):
+        call_command('update_easyfilters_stats', 'tests.Book', 'edition', 'genre')
+        self.assertEqual(sorted(FieldStatistics.objects.values_list('field', flat=True)),
+                         ['edition', 'genre'])
+        call_command('update_easyfilters_stats', 'tests.Author')
+        self.assertEqual(FieldStatistics.objects.filter(model='tests.Author').count(), 2)
+        FieldStatistics.objects.update(rows=0)
+        call_command('update_easyfilters_stats')
+        self.assertFalse(FieldStatistics.objects.filter(rows=0).exists())
+
+    def test_use_field_stats(self):
+        class BookFilterSet(FilterSet):
+            fields = ['edition', 'genre', ('authors', dict(max_choices=100)), 'price']
+            use_field_stats = True
+            field_stats_max_values = 2
+            field_stats_sample_rows = 5
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        edition, genre, authors, price = fs.filters
+        self.assertEqual(type(edition), NumericRangeFilter)
+        self.assertEqual((genre.max_choices, genre.order_by_count), (2, True))
+        self.assertEqual(authors.max_choices, 100)
+        self.assertEqual(genre.approximate, Book.objects.count() // 5 + 1)
+
+    def test_use_field_stats_class(self):
+        # The class is chosen for each FilterSet, so compile() doesn't need
+        # the statistics, and the choice follows changes to them.
+        class BookFilterSet(FilterSet):
+            fields = ['edition', ('rating', {}, ValuesFilter)]
+            use_field_stats = True
+            field_stats_max_values = 2
+
+        with self.assertNumQueries(0):
+            specs = BookFilterSet.compile(Book)
+        self.assertEqual([klass for name, klass, opts in specs], [ValuesFilter, ValuesFilter])
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        self.assertEqual([type(f) for f in fs.filters], [NumericRangeFilter, ValuesFilter])
+
+        FieldStatistics.objects.filter(field='edition').update(distinct=2)
+        stats._local.clear()
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        self.assertEqual(type(fs.filters[0]), ValuesFilter)
+
+    def test_numeric_range_few_values(self):
+        class BookFilterSet(FilterSet):
+            fields = [('edition', {}, NumericRangeFilter)]
+            use_field_stats = True
+
+        qs = Book.objects.all()
+        fs = BookFilterSet(qs, QueryDict(''))
+        with self.assertNumQueries(1):
+            choices = fs.get_filter_choices('edition')
+        self.assertEqual(choices, NumericRangeFilter('edition', Book, MultiValueDict()).get_choices(qs))
+
+        # If the statistics are out of date, ranges are still used when there
+        # are too many values.
+        fs = BookFilterSet(qs, QueryDict(''))
+        edition = fs.filters[0]
+        edition.max_links = 2
+        edition.field_stats = dict(edition.field_stats, distinct=2)
+        self.assertTrue(edition.has_few_values())
+        with self.assertNumQueries(2):
+            choices = fs.get_filter_choices('edition')
+        self.assertEqual(choices, NumericRangeFilter('edition', Book, MultiValueDict(),
+                                                     max_links=2).get_choices(qs))
+        self.assertTrue(all(len(c.params['edition'].split('..')) == 2 for c in choices))
+
 
 class TestFilters(TestCase):
     fixtures = ['django_easyfilters_tests']
@@ -262,13 +1007,38 @@ class TestFilters(TestCase):
         qs_reverted = filter3.apply_filter(qs)
         self.assertEqual(qs, qs_reverted)
 
+    def test_foreignkey_lazy_lookup(self):
+        """
+        A ForeignKey filter should only look up the chosen objects when they
+        are needed for display.
+        """
+        qs = Book.objects.all()
+        genre = Genre.objects.get(id=6)
+        data = MultiValueDict({'genre': [str(genre.pk)]})
+        with self.assertNumQueries(0):
+            filter1 = ForeignKeyFilter('genre', Book, data)
+            qs_filtered = filter1.apply_filter(qs)
+        self.assertEqual(list(qs_filtered), list(qs.filter(genre=genre)))
+
+        with self.assertNumQueries(1):
+            choices = filter1.get_choices(qs_filtered)
+        self.assertEqual([(c.label, c.link_type) for c in choices],
+                         [(text_type(genre), FILTER_REMOVE)])
+
     def test_foreignkey_invalid_query(self):
         self.do_invalid_query_param_test(lambda params:
                                          ForeignKeyFilter('genre', Book, params),
                                          MultiValueDict({'genre': ['xxx']}))
-        self.do_missing_related_object_test(lambda params:
-                                            ForeignKeyFilter('genre', Book, params),
-                                            MultiValueDict({'genre': ['1000']}))
+
+        # An object that doesn't exist is filtered on without looking it up, so
+        # there is a link to remove it.
+        filter1 = ForeignKeyFilter('genre', Book, MultiValueDict({'genre': ['1000']}))
+        qs_filtered = filter1.apply_filter(Book.objects.all())
+        self.assertEqual(list(qs_filtered), [])
+        self.assertTrue(filter1.has_choices(qs_filtered))
+        choices = filter1.get_choices(qs_filtered)
+        self.assertEqual([(c.label, c.link_type, c.query) for c in choices],
+                         [('1000', FILTER_REMOVE, '')])
 
     def test_values_filter(self):
         """
@@ -406,10 +1176,9 @@ class TestFilters(TestCase):
         # ...and excludes Jane Eyre
         self.assertFalse(qs_emily.filter(name='Jane Eyre').exists())
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             # 0 query for all chosen objects (already done)
-            # 1 query for available objects
-            # 1 query for counts
+            # 1 query for available objects and counts
             choices = filter1.get_choices(qs_emily)
 
         # We should have a 'choices' that includes charlotte and anne
@@ -446,6 +1215,119 @@ class TestFilters(TestCase):
                           (text_type(anne), FILTER_REMOVE),
                           (text_type(charlotte), FILTER_ADD)])
 
+    def test_related_filters_join_related(self):
+        """
+        Tests that join_related=False gives the same choices, using a separate
+        query for related objects.
+        """
+        qs = Book.objects.all()
+        for filter_class, field, params in [
+                (ForeignKeyFilter, 'genre', {}),
+                (ManyToManyFilter, 'authors', {}),
+                (ManyToManyFilter, 'authors', {'authors': ['2']})]:
+            filter1 = filter_class(field, Book, MultiValueDict(params))
+            filter2 = filter_class(field, Book, MultiValueDict(params), join_related=False)
+            qs_filtered = filter1.apply_filter(qs)
+            with self.assertNumQueries(1):
+                choices1 = filter1.get_choices_add(qs_filtered)
+            with self.assertNumQueries(2):
+                choices2 = filter2.get_choices_add(qs_filtered)
+            self.assertTrue(len(choices1) > 0)
+            self.assertEqual(choices1, choices2)
+
+    def test_related_filters_label_fields(self):
+        """
+        Tests that label_fields and label_func control the labels, and the
+        fields fetched.
+        """
+        qs = Book.objects.all()
+        filter1 = ForeignKeyFilter('genre', Book, MultiValueDict(), label_fields=['name'])
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict(), label_fields=['name'],
+                                   label_func=lambda row: row['name'].upper())
+        choices1 = filter1.get_choices_add(qs)
+        self.assertEqual(choices1, ForeignKeyFilter('genre', Book, MultiValueDict()).get_choices_add(qs))
+        self.assertEqual([c.label.upper() for c in choices1],
+                         [c.label for c in filter2.get_choices_add(qs)])
+
+        filter3 = ManyToManyFilter('authors', Book, MultiValueDict(), label_fields=['name'],
+                                   label_func=lambda row: 'Author %s' % row['id'])
+        choices3 = filter3.get_choices_add(qs)
+        self.assertEqual(choices3[0].label, 'Author %s' % Author.objects.all()[0].id)
+
+        # Fields left out of label_fields are loaded if they are used, rather
+        # than taking their default values.
+        class LikesFilter(ManyToManyFilter):
+            def render_choice_object(self, choice):
+                return 'Likes: %s' % choice.likes
+
+        author = Author.objects.all()[0]
+        Author.objects.filter(pk=author.pk).update(likes=5)
+        filter4 = LikesFilter('authors', Book, MultiValueDict(), label_fields=['id'])
+        self.assertEqual(filter4.get_choices_add(qs)[0].label, 'Likes: 5')
+
+    def test_related_filters_label_cache(self):
+        """
+        Tests that label_cache_size caches labels between requests, and that the
+        cache is invalidated when a related object is saved.
+        """
+        qs = Book.objects.all()
+        for filter_class, field, rel_model in [(ForeignKeyFilter, 'genre', Genre),
+                                               (ManyToManyFilter, 'authors', Author)]:
+            expected = filter_class(field, Book, MultiValueDict()).get_choices_add(qs)
+            filter1 = filter_class(field, Book, MultiValueDict(), label_cache_size=100)
+            self.assertEqual(filter1.get_choices_add(qs), expected)
+            filter2 = filter_class(field, Book, MultiValueDict(), label_cache_size=100)
+            with self.assertNumQueries(1):
+                self.assertEqual(filter2.get_choices_add(qs), expected)
+
+            obj = rel_model.objects.get(name=expected[0].label)
+            obj.name = 'ZZZ'
+            obj.save()
+            filter3 = filter_class(field, Book, MultiValueDict(), label_cache_size=100)
+            with self.assertNumQueries(2):
+                choices = filter3.get_choices_add(qs)
+            self.assertEqual(choices[-1].label, 'ZZZ')
+            self.assertEqual(choices[-1].count, expected[0].count)
+            # The save is rolled back, but the label cache doesn't know that.
+            filter3.get_label_cache().invalidate(obj)
+
+    def test_related_filters_labels_chunked(self):
+        """
+        Tests that labels for counts found without joining to the related table
+        are looked up in bounded queries.
+        """
+        qs = Book.objects.all()
+        old_value = filters.LABELS_PER_QUERY
+        filters.LABELS_PER_QUERY = 2
+        try:
+            for filter_class, field, rel_model in [(ForeignKeyFilter, 'genre', Genre),
+                                                   (ManyToManyFilter, 'authors', Author)]:
+                expected = filter_class(field, Book, MultiValueDict()).get_choices_add(qs)
+                filter1 = filter_class(field, Book, MultiValueDict(), join_related=False)
+                with CaptureQueries(connection) as ctx:
+                    self.assertEqual(filter1.get_choices_add(qs), expected)
+                label_queries = [q for q in ctx.captured_queries
+                                 if 'FROM "%s"' % rel_model._meta.db_table in q['sql']]
+                self.assertEqual(len(label_queries), (len(expected) + 1) // 2)
+        finally:
+            filters.LABELS_PER_QUERY = old_value
+
+    def test_manytomany_filter_apply_filter(self):
+        """
+        Tests that choosing several related objects gives the same results as
+        filtering on each in turn, without joins.
+        """
+        qs = Book.objects.all()
+        for pks in [[2], [2, 6], [2, 6, 7], [2, 4], [4, 5], [4, 5, 5]]:
+            data = MultiValueDict({'authors': [str(pk) for pk in pks]})
+            filter1 = ManyToManyFilter('authors', Book, data)
+            qs_filtered = filter1.apply_filter(qs)
+            expected = qs
+            for pk in pks:
+                expected = expected.filter(authors=pk)
+            self.assertEqual(list(qs_filtered.order_by('pk')), list(expected.order_by('pk').distinct()))
+            self.assertNotIn('JOIN', str(qs_filtered.query))
+
     def test_manytomany_filter_invalid_query(self):
         self.do_invalid_query_param_test(lambda params:
                                          ManyToManyFilter('authors', Book, params),
@@ -644,6 +1526,46 @@ class TestFilters(TestCase):
         self.assertEqual(len(choices), 1)
         self.assertEqual(choices[0].link_type, FILTER_REMOVE)
 
+    def test_datetime_filter_single_query(self):
+        """
+        Tests that single_query=True gives the same choices as the default,
+        using one query.
+        """
+        qs = Book.objects.all()
+        for params in [{}, {'date_published': ['1813']}, {'date_published': ['1813..1850']},
+                       {'date_published': ['1818-08']}, {'date_published': ['1818-08-24']},
+                       {'date_published': ['1900..2100']}]:
+            for max_depth in [None, 'year', 'month']:
+                for max_links in [3, 10]:
+                    kwargs = dict(max_depth=max_depth, max_links=max_links)
+                    f1 = DateTimeFilter('date_published', Book, MultiValueDict(params), **kwargs)
+                    f2 = DateTimeFilter('date_published', Book, MultiValueDict(params),
+                                        single_query=True, **kwargs)
+                    qs_filtered = f1.apply_filter(qs)
+                    # Nothing to do if a single day is chosen
+                    with self.assertNumQueries(0 if params == {'date_published': ['1818-08-24']} else 1):
+                        choices = f2.get_choices(qs_filtered)
+                    self.assertEqual(f1.get_choices(qs_filtered), choices)
+
+    def test_date_histogram(self):
+        qs = Book.objects.filter(date_published__gte=date(1818, 1, 1))
+        rows = list(date_histogram(qs, 'date_published', 'month'))
+        self.assertEqual(sum(count for dt, count in rows), qs.count())
+        self.assertEqual([(dt.year, dt.month) for dt, count in rows],
+                         sorted(set((b.date_published.year, b.date_published.month) for b in qs)))
+        self.assertEqual(rows[0][1],
+                         qs.filter(date_published__year=rows[0][0].year,
+                                   date_published__month=rows[0][0].month).count())
+
+    def test_date_histogram_inherited_field(self):
+        Employee.objects.create(name="Joe", employer="Acme", date_of_birth=date(2011, 1, 10))
+        Employee.objects.create(name="Peter", employer="Acme", date_of_birth=date(2011, 1, 20))
+        Employee.objects.create(name="Anne", employer="Acme", date_of_birth=date(2012, 3, 1))
+        Person.objects.create(name="Jane", date_of_birth=date(2011, 1, 5))
+        rows = list(date_histogram(Employee.objects.all(), 'date_of_birth', 'month'))
+        self.assertEqual([((dt.year, dt.month), count) for dt, count in rows],
+                         [((2011, 1), 2), ((2012, 3), 1)])
+
     def test_datetime_filter_invalid_query(self):
         self.do_invalid_query_param_test(lambda params: DateTimeFilter('date_published', Book, params, max_links=10),
                                          MultiValueDict({'date_published': ['1818xx']}))
@@ -832,22 +1754,31 @@ class TestFilters(TestCase):
         # Limit to single value to force the case
         qs = Book.objects.filter(price=Decimal('3.50'))
 
-        # Should only take 2 queries - one to find out how many distinct values,
-        # one to get the counts.
-        with self.assertNumQueries(2):
+        # Should only take 1 query - the statistics for the values tell us
+        # the only value and its count.
+        with self.assertNumQueries(1):
             choices = filter1.get_choices(qs)
 
         self.assertEqual(len(choices), 1)
         self.assertTrue('3.5' in choices[0].label)
+        self.assertEqual(choices[0].count, qs.count())
+        self.assertEqual(filter1.get_choices_add(qs)[0].params.getlist('price'), ['3.50i'])
+
+        # With several values, one more query is needed to get the counts.
+        qs = Book.objects.filter(price__lte=Decimal('4.50'))
+        with self.assertNumQueries(2):
+            choices = filter1.get_choices(qs)
+        self.assertTrue(len(choices) > 1)
+        self.assertEqual(sum(c.count for c in choices), qs.count())
 
     def test_numericrange_filter_range_choices(self):
         # If data is more than max_links, we should get a range
         filter1 = NumericRangeFilter('price', Book, MultiValueDict(), max_links=8)
 
         qs = Book.objects.all()
-        # Should take 3 queries - one to find out how many distinct values,
-        # one to find a range, one to get the counts.
-        with self.assertNumQueries(3):
+        # Should take 2 queries - one to find out how many distinct values and
+        # the range, one to get the counts.
+        with self.assertNumQueries(2):
             choices = filter1.get_choices(qs)
 
         self.assertTrue(len(choices) <= 8)
@@ -886,6 +1817,45 @@ class TestFilters(TestCase):
                          list(qs.filter(price__gte=Decimal('3.50'),
                                         price__lte=Decimal('4.00'))))
 
+    def test_range_filter_apply_filter_combined(self):
+        """
+        Tests that drill down choices are combined into a single range.
+        """
+        qs = Book.objects.all()
+        params1 = MultiValueDict({'price': ['3.50i..10.00i', '4.00..6.00i', '5.00i..6.00']})
+        filter1 = NumericRangeFilter('price', Book, params1)
+        qs_filtered1 = filter1.apply_filter(qs)
+        self.assertEqual(str(qs_filtered1.query).count('price'), str(qs.query).count('price') + 2)
+        self.assertEqual(list(qs_filtered1),
+                         list(qs.filter(price__gte=Decimal('5.00'),
+                                        price__lt=Decimal('6.00'))))
+
+        params2 = MultiValueDict({'date_published': ['1813..1820', '1818-08', '1818-08-24']})
+        filter2 = DateTimeFilter('date_published', Book, params2)
+        qs_filtered2 = filter2.apply_filter(qs)
+        self.assertEqual(str(qs_filtered2.query).count('date_published'),
+                         str(qs.query).count('date_published') + 2)
+        self.assertEqual(list(qs_filtered2),
+                         list(qs.filter(date_published=date(1818, 8, 24))))
+
+        # Ranges that don't overlap
+        params3 = MultiValueDict({'price': ['3.50i..4.00', '4.00i..5.00i']})
+        filter3 = NumericRangeFilter('price', Book, params3)
+        self.assertEqual(list(filter3.apply_filter(qs)), [])
+
+    def test_intersect_range_lookups(self):
+        self.assertEqual(intersect_range_lookups('x', [{'x__gt': 1, 'x__lt': 10},
+                                                       {'x__gte': 1, 'x__lte': 5}]),
+                         {'x__gt': 1, 'x__lte': 5})
+        self.assertEqual(intersect_range_lookups('x', [{'x__gte': 1, 'x__lt': 10}, {'x': 3}]),
+                         {'x': 3})
+        self.assertIs(intersect_range_lookups('x', [{'x__gte': 1, 'x__lt': 3}, {'x': 3}]),
+                      EMPTY_RANGE)
+        self.assertIs(intersect_range_lookups('x', [{'x__gte': 3, 'x__lt': 3}]), EMPTY_RANGE)
+        self.assertEqual(intersect_range_lookups('x', [{'x__gte': 3, 'x__lte': 3}]),
+                         {'x__gte': 3, 'x__lte': 3})
+        self.assertIs(intersect_range_lookups('x', [{'x__in': [1]}]), None)
+
     def test_numericrange_filter_manual_ranges(self):
         """
         Test we can specify 'ranges' and it works as expected.
@@ -908,6 +1878,32 @@ class TestFilters(TestCase):
         self.assertEqual(choices[0].count, qs.filter(price__gte=Decimal('3.50'), price__lte=Decimal('5.00')).count())
         self.assertEqual(choices[1].count, qs.filter(price__gt=Decimal('5.00'), price__lte=Decimal('6.00')).count())
 
+    def test_numeric_range_counts(self):
+        """
+        Tests the counts for uniform ranges (calculated arithmetically) and
+        other ranges (calculated with CASE) against counts done in Python.
+        """
+        def check(qs, field, ranges):
+            expected = {}
+            for val in qs.values_list(field, flat=True):
+                for i, r in enumerate(ranges):
+                    if r[0] < val <= r[1] or (i == 0 and val == r[0]):
+                        expected[r] = expected.get(r, 0) + 1
+                        break
+            counts = numeric_range_counts(qs, field, ranges)
+            self.assertEqual(dict(counts), expected)
+
+        qs = Book.objects.all()
+        for max_items in [2, 3, 5, 8, 13, 20, 50]:
+            check(qs, 'price', auto_ranges(Decimal('3.50'), Decimal('44.99'), max_items))
+            check(qs.filter(rating__isnull=False), 'rating', auto_ranges(0.3, 4.9, max_items))
+            check(qs, 'edition', auto_ranges(1, 20, max_items))
+        check(qs, 'price', [(Decimal('3.50'), Decimal('4.00')),
+                            (Decimal('4.00'), Decimal('4.99')),
+                            (Decimal('4.99'), Decimal('6.00')),
+                            (Decimal('6.00'), Decimal('10.99')),
+                            (Decimal('10.99'), Decimal('50.00'))])
+
     def test_numericrange_filter_manual_ranges_labels(self):
         """
         Test we can specify 'ranges' with manual labels
@@ -954,6 +1950,266 @@ class TestFilters(TestCase):
         # and Genre ordering is by that field)
         self.assertEqual(choices2, sorted(choices2, key=operator.attrgetter('label')))
 
+    def test_max_choices(self):
+        """
+        Tests the 'max_choices' option.
+        """
+        qs = Book.objects.all()
+        all_counts = dict((c.label, c.count) for c in
+                          ForeignKeyFilter('genre', Book, MultiValueDict()).get_choices(qs))
+        top = sorted(all_counts.values(), reverse=True)[:2]
+        for join_related in [True, False]:
+            filter1 = ForeignKeyFilter('genre', Book, MultiValueDict(), order_by_count=True,
+                                       max_choices=2, join_related=join_related)
+            choices = filter1.get_choices(qs)
+            self.assertEqual([c.count for c in choices], top)
+            self.assertTrue(filter1.more_choices)
+
+        filter2 = ValuesFilter('edition', Book, MultiValueDict(), order_by_count=True,
+                               max_choices=3)
+        self.assertNumQueries(1, lambda: filter2.get_choices(qs))
+        self.assertFalse(filter2.more_choices)
+
+        # Chosen values are always shown.
+        filter3 = ManyToManyFilter('authors', Book, MultiValueDict({'authors': ['2']}),
+                                   max_choices=1)
+        choices = filter3.get_choices(filter3.apply_filter(qs))
+        self.assertEqual([c.link_type for c in choices], [FILTER_REMOVE, FILTER_ADD])
+
+    def test_approximate(self):
+        """
+        Tests the 'approximate' option.
+        """
+        qs = Book.objects.all()
+        sample = list(sample_queryset(qs, 3))
+        self.assertTrue(0 < len(sample) < qs.count())
+        self.assertTrue(all(b.pk % 3 == 0 for b in sample))
+
+        for field, filter_class in [('edition', ValuesFilter),
+                                    ('genre', ForeignKeyFilter),
+                                    ('authors', ManyToManyFilter)]:
+            exact = filter_class(field, Book, MultiValueDict()).get_choices(qs)
+            filter1 = filter_class(field, Book, MultiValueDict(), approximate=3,
+                                   approximate_threshold=5)
+            choices = filter1.get_choices(qs)
+            self.assertTrue(all(c.is_estimate and c.count % 3 == 0 for c in choices))
+            self.assertNotEqual(choices, exact)
+
+            # The sample is of the filtered rows.
+            filtered = qs.filter(genre__name__in=['Classics', 'Fantasy', 'Romance'])
+            self.assertEqual(
+                [(c.label, c.count) for c in filter1.get_choices(filtered)],
+                [(c.label, c.count * 3) for c in
+                 filter_class(field, Book, MultiValueDict()).get_choices(
+                     filtered.filter(pk__in=[b.pk for b in sample]))
+                 if c.count])
+
+            # Switches to exact counts for small result sets.
+            filter2 = filter_class(field, Book, MultiValueDict(), approximate=3)
+            choices = filter2.get_choices(qs)
+            self.assertEqual(choices, exact)
+            self.assertFalse(any(c.is_estimate for c in choices))
+
+    def test_approximate_filterset(self):
+        class BookFilterSet(FilterSet):
+            fields = ['edition', ('genre', dict(approximate_threshold=5)), 'date_published']
+            approximate_counts = 3
+            batch_counts = True
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        self.assertIn('(~', fs.render())
+        fs.renderer = FastRenderer()
+        self.assertEqual(fs.render(), BookFilterSet(Book.objects.all(), QueryDict('')).render())
+        self.assertFalse(any(c.is_estimate for c in fs.get_filter_choices('edition')))
+        self.assertTrue(all(c.is_estimate for c in fs.get_filter_choices('genre')))
+        self.assertFalse(any(c.is_estimate for c in fs.get_filter_choices('date_published')))
+
+        # With other filters applied
+        class M2MFilterSet(FilterSet):
+            fields = ['genre', ('authors', dict(approximate_threshold=5))]
+            approximate_counts = 3
+
+        fs = M2MFilterSet(Book.objects.all(), QueryDict('genre=%s' % Genre.objects.get(name='Romance').pk))
+        self.assertTrue(all(c.is_estimate for c in fs.get_filter_choices('authors')))
+        fs.render()
+
+        # The decision to estimate counts needs one query per QuerySet, not one
+        # per filter.
+        class SampledFilterSet(FilterSet):
+            fields = [('edition', dict(approximate_threshold=5)),
+                      ('genre', dict(approximate_threshold=5)),
+                      ('authors', dict(approximate_threshold=5))]
+            approximate_counts = 3
+
+        fs = SampledFilterSet(Book.objects.all(), QueryDict(''))
+        with CaptureQueries(connection) as ctx:
+            for f in fs.filters:
+                self.assertTrue(all(c.is_estimate for c in fs.get_filter_choices(f.field)))
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if 'easyfilter_subquery' in q['sql'] and 'COUNT(*)' in q['sql']]), 1)
+
+    def test_count_cap(self):
+        """
+        Tests the 'count_cap' option.
+        """
+        qs = Book.objects.all()
+        for field, filter_class in [('edition', ValuesFilter),
+                                    ('binding', ChoicesFilter),
+                                    ('genre', ForeignKeyFilter),
+                                    ('authors', ManyToManyFilter)]:
+            exact = filter_class(field, Book, MultiValueDict()).get_choices(qs)
+            filter1 = filter_class(field, Book, MultiValueDict(), count_cap=2)
+            choices = filter1.get_choices(qs)
+            self.assertEqual([c.label for c in choices], [c.label for c in exact])
+            self.assertEqual([(min(c.count, 2), c.count > 2) for c in exact],
+                             [(c.count, c.is_capped) for c in choices])
+            self.assertTrue(any(c.is_capped for c in choices))
+
+        # The values come from the related table, a slice at a time, and
+        # are counted until max_choices have been found.
+        filter2 = ForeignKeyFilter('genre', Book, MultiValueDict(), count_cap=2,
+                                   max_choices=2, join_related=False)
+        with CaptureQueries(connection) as ctx:
+            choices = filter2.get_choices(qs)
+        self.assertEqual([(c.label, c.count) for c in choices],
+                         [(c.label, min(c.count, 2))
+                          for c in ForeignKeyFilter('genre', Book, MultiValueDict(),
+                                                    max_choices=2).get_choices(qs)])
+        sql = [q['sql'] for q in ctx.captured_queries]
+        self.assertIn('tests_genre', sql[0])
+        self.assertNotIn('DISTINCT', sql[0])
+        self.assertIn('UNION ALL', sql[1])
+
+        # Without candidate values, a normal count query is used.
+        filter3 = ValuesFilter('edition', Book, MultiValueDict(), count_cap=2)
+        self.assertNumQueries(1, lambda: filter3.get_choices(qs))
+
+        # Without max_choices, the related table isn't walked.
+        filter4 = ForeignKeyFilter('genre', Book, MultiValueDict(), count_cap=2)
+        with CaptureQueries(connection) as ctx:
+            filter4.get_choices(qs)
+        self.assertFalse(any('UNION ALL' in q['sql'] for q in ctx.captured_queries))
+
+        # Nor when the values found are too sparse.
+        old_values = queries.CAPPED_COUNTS_PER_QUERY, queries.CAPPED_COUNTS_MAX_QUERIES
+        queries.CAPPED_COUNTS_PER_QUERY, queries.CAPPED_COUNTS_MAX_QUERIES = 1, 3
+        try:
+            filter5 = ForeignKeyFilter('genre', Book, MultiValueDict(), count_cap=2,
+                                       max_choices=5)
+            with CaptureQueries(connection) as ctx:
+                choices = filter5.get_choices(qs)
+        finally:
+            queries.CAPPED_COUNTS_PER_QUERY, queries.CAPPED_COUNTS_MAX_QUERIES = old_values
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if 'easyfilter_subquery' in q['sql']]), 3)
+        self.assertEqual([(c.label, c.count) for c in choices],
+                         [(c.label, min(c.count, 2))
+                          for c in ForeignKeyFilter('genre', Book, MultiValueDict(),
+                                                    max_choices=5).get_choices(qs)])
+
+        # QuerySets that can't match anything
+        class CappedFilterSet(FilterSet):
+            fields = [
+                ('binding', dict(count_cap=2)),
+                ('genre', dict(count_cap=2, max_choices=3)),
+                ('authors', dict(count_cap=2, max_choices=3)),
+                'price',
+                'date_published',
+            ]
+
+        for empty_qs, query in [(Book.objects.none(), ''),
+                                (qs, 'price=0i..1i&price=5i..6i'),
+                                (qs, 'date_published=1990&date_published=1991-02')]:
+            fs = CappedFilterSet(empty_qs, QueryDict(query))
+            for field in ['binding', 'genre', 'authors']:
+                self.assertEqual(fs.get_filter_choices(field), [])
+            fs.render()
+
+        class BookFilterSet(FilterSet):
+            fields = [('edition', dict(count_cap=2))]
+
+        self.assertIn('(2+)', BookFilterSet(qs, QueryDict('')).render())
+
+    def test_choices_page(self):
+        qs = Book.objects.all()
+        filter1 = ManyToManyFilter('authors', Book, MultiValueDict(), max_choices=1)
+        all_choices = [c for c in ManyToManyFilter('authors', Book, MultiValueDict()).get_choices(qs)]
+        page1, more = filter1.get_choices_page(qs, 2)
+        self.assertEqual(page1, all_choices[:2])
+        self.assertTrue(more)
+        page2, more = filter1.get_choices_page(qs, 2, after=filter1.choice_value_param(page1[-1]))
+        self.assertEqual(page2, all_choices[2:4])
+        self.assertEqual(filter1.get_choices_page(qs, 2, offset=2)[0], page2)
+        # max_choices still applies to get_choices
+        self.assertEqual(len(filter1.get_choices(qs)), 1)
+
+        prefix = all_choices[0].label[:2].upper()
+        page, more = filter1.get_choices_page(qs, 100, prefix=prefix)
+        self.assertEqual(page, [c for c in all_choices
+                                if c.label.lower().startswith(prefix.lower())])
+        self.assertFalse(more)
+        self.assertRaises(ValueError, filter1.get_choices_page, qs, 2, after='12345')
+
+    def test_choices_page_queries(self):
+        # Pages selected by the database are the same as pages of all the
+        # choices.
+        qs = Book.objects.all()
+        for field, filter_class, prefixes in [
+                ('authors', ManyToManyFilter, ['', 'c', 'Jane']),
+                ('genre', ForeignKeyFilter, ['', 's']),
+                ('name', ValuesFilter, ['', 'the']),
+                ('binding', ChoicesFilter, ['', 'hard'])]:
+            for opts in [{}, {'order_by_count': True}]:
+                f = filter_class(field, Book, MultiValueDict(), **opts)
+                all_choices = [c for c in f.get_choices(qs) if c.link_type == FILTER_ADD]
+                for prefix in prefixes:
+                    expected = [c for c in all_choices
+                                if c.label.lower().startswith(prefix.lower())]
+                    page, more = f.get_choices_page(qs, 2, prefix=prefix)
+                    pages = [page]
+                    while more:
+                        page, more = f.get_choices_page(qs, 2, prefix=prefix,
+                                                        after=f.choice_value_param(page[-1]))
+                        pages.append(page)
+                    self.assertEqual(sum(pages, []), expected)
+                    self.assertEqual(f.get_choices_page(qs, 2, offset=1, prefix=prefix)[0],
+                                     expected[1:3])
+
+        # Only the page is fetched.
+        f = ValuesFilter('name', Book, MultiValueDict())
+        with self.assertNumQueries(1):
+            page, more = f.get_choices_page(qs, 2)
+        self.assertEqual(len(page), 2)
+        self.assertTrue(more)
+        self.assertEqual(ValuesFilter('name', Book, MultiValueDict({'name': ['x']}))
+                         .get_choices_page(qs, 2), ([], False))
+
+    def test_choices_page_view(self):
+        response = self.client.get('/books-filter-choices/', {'field': 'authors', 'binding': 'H'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(data['choices']), 2)
+        self.assertTrue(all('binding=H' in c['query'] for c in data['choices']))
+        self.assertEqual(data['after'], data['choices'][-1]['value'])
+
+        response = self.client.get('/books-filter-choices/', {'field': 'authors', 'binding': 'H',
+                                                               'after': data['after']})
+        data2 = json.loads(response.content.decode('utf-8'))
+        self.assertNotEqual(data2['choices'][0], data['choices'][0])
+
+        response = self.client.get('/books-filter-choices/', {'field': 'foo'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_max_choices_filterset(self):
+        class BookFilterSet(FilterSet):
+            fields = [('genre', dict(order_by_count=True, max_choices=1))]
+            batch_counts = True
+
+        fs = BookFilterSet(Book.objects.all(), QueryDict(''))
+        self.assertEqual(len(fs.get_filter_choices('genre')), 1)
+        self.assertTrue(fs.has_more_choices(fs.filters[0]))
+        self.assertTrue(fs.as_data()['filters'][0]['more'])
+
 
 class TestCustomFilters(TestCase):
 
@@ -3,6 +3,7 @@ from django.shortcuts import render
 from django_easyfilters.tests.models import Book, Author
 from django_easyfilters import FilterSet
 from django_easyfilters.filters import NumericRangeFilter
+from django_easyfilters.views import FilterChoicesPageView, FilterSetDataView
 
 
 class BookFilterSet(FilterSet):
@@ -16,6 +17,17 @@ class BookFilterSet(FilterSet):
     ]
 
 
+class BookFilterSetDataView(FilterSetDataView):
+    filterset_class = BookFilterSet
+    queryset = Book.objects.all()
+
+
+class BookFilterChoicesPageView(FilterChoicesPageView):
+    filterset_class = BookFilterSet
+    queryset = Book.objects.all()
+    paginate_by = 2
+
+
 def books(request):
     books = Book.objects.all()
     booksfilter = BookFilterSet(books, request.GET)
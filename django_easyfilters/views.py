@@ -0,0 +1,72 @@
+import json
+
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.views.generic import View
+
+
+class FilterSetDataView(View):
+    """
+    A view that returns the choices for the filters of a FilterSet as JSON,
+    using FilterSet.to_json(), for the querystring of the request.
+
+    Set 'filterset_class' and 'queryset', or override get_queryset(). A
+    fingerprint from previous output can be passed in the query parameter
+    named by 'fingerprint_param', so that only changed filters are returned
+    in full.
+    """
+    filterset_class = None
+    queryset = None
+    fingerprint_param = 'fingerprint'
+
+    def get_queryset(self):
+        return self.queryset.all()
+
+    def get_filterset(self, params):
+        return self.filterset_class(self.get_queryset(), params)
+
+    def get(self, request, *args, **kwargs):
+        params = request.GET.copy()
+        fingerprint = params.pop(self.fingerprint_param, [None])[0]
+        filterset = self.get_filterset(params)
+        return HttpResponse(filterset.to_json(fingerprint=fingerprint),
+                            content_type='application/json')
+
+
+class FilterChoicesPageView(FilterSetDataView):
+    """
+    A view that returns a page of the choices for one filter of a FilterSet
+    as JSON, using FilterSet.choices_page_data(), so that the choices of
+    large filters can be loaded incrementally.
+
+    The field is given in the query parameter named by 'field_param', and the
+    page is selected using the 'offset_param' or 'after_param' parameters,
+    with an optional label prefix in 'prefix_param'. These parameters are not
+    passed on to the FilterSet. Pages have 'paginate_by' choices.
+    """
+    field_param = 'field'
+    offset_param = 'offset'
+    after_param = 'after'
+    prefix_param = 'prefix'
+    paginate_by = 50
+
+    def get(self, request, *args, **kwargs):
+        params = request.GET.copy()
+        field = params.pop(self.field_param, [None])[0]
+        offset = params.pop(self.offset_param, ['0'])[0]
+        after = params.pop(self.after_param, [None])[0]
+        prefix = params.pop(self.prefix_param, [None])[0]
+        try:
+            offset = int(offset)
+        except ValueError:
+            return HttpResponseBadRequest()
+        if offset < 0:
+            return HttpResponseBadRequest()
+        filterset = self.get_filterset(params)
+        try:
+            data = filterset.choices_page_data(field, self.paginate_by, offset=offset,
+                                               prefix=prefix, after=after)
+        except KeyError:
+            raise Http404
+        except ValueError:
+            return HttpResponseBadRequest()
+        return HttpResponse(json.dumps(data), content_type='application/json')